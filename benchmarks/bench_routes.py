@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+'''Runs every route through the Flask test client against synthetic databases of several sizes,
+records latency, number of SQL statements and peak memory, and compares them to baseline.json.
+
+	python3 benchmarks/bench_routes.py                 # compare, exits with 1 on regressions
+	python3 benchmarks/bench_routes.py --update        # store the results as the new baseline
+	python3 benchmarks/bench_routes.py --scale small   # only one scale
+
+Statement counts and memory should be the same on every machine, latencies are only comparable to a baseline from the same machine.'''
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SCALES = {
+	'small': {'users': 20, 'weeks': 8, 'destinations': 3, 'items_per_destination': 10},
+	'medium': {'users': 100, 'weeks': 52, 'destinations': 5, 'items_per_destination': 30},
+	'large': {'users': 300, 'weeks': 156, 'destinations': 8, 'items_per_destination': 60},
+}
+
+
+def run_scale(scale, repeat):
+	'''Runs in a separate process per scale, because the workers' caches are per process.'''
+	import sqlalchemy
+	from noodlz import create_app
+	from noodlz.models import db, Trip, Item, User
+	from noodlz.__main__ import createdb
+
+	app = create_app()
+	with app.app_context():
+		# stdout is reserved for the results
+		with contextlib.redirect_stdout(sys.stderr):
+			createdb(argparse.Namespace(testdata=False, synthetic=True, seed=0, **SCALES[scale]))
+		# The busiest buyer looks at one of their old trips, and orders on the newest open trip
+		buyer_id, = db.session.query(Trip.user_id).group_by(Trip.user_id).order_by(db.func.count(Trip.id).desc(), Trip.user_id).first()
+		buyer = User.query.filter_by(id=buyer_id).first().name
+		old_trip = Trip.query.filter_by(user_id=buyer_id).order_by(Trip.date).first()
+		open_trip = Trip.query.filter_by(closed=False).order_by(Trip.date.desc(), Trip.id).first() or Trip.query.order_by(Trip.date.desc(), Trip.id).first()
+		open_trip.closed = False
+		db.session.commit()
+		menu = [item.id for item in Item.query.filter_by(destination_id=open_trip.destination_id, historical=False)]
+		latest_date, open_trip_id = open_trip.date, open_trip.id
+		old_date, old_trip_id = old_trip.date, old_trip.id
+		statements = []
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+	client = app.test_client()
+	client.post('/login', data={'user': buyer, 'pass': 'password'})
+	order_counter = iter(range(10 ** 9))
+
+	def order_form():
+		n = next(order_counter)
+		return {f'item-{item_id}': str((n + i) % 3) for i, item_id in enumerate(menu)}
+
+	def api_counts():
+		n = next(order_counter)
+		return {'counts': {str(item_id): (n + i) % 3 for i, item_id in enumerate(menu)}}
+
+	def events():
+		response = client.get(f'/{latest_date}/events?after=0')
+		response.get_data()
+		response.close()
+		return response
+
+	routes = [
+		('POST login', lambda: client.post('/login', data={'user': buyer, 'pass': 'password'})),
+		('GET date (current)', lambda: client.get(f'/{latest_date}/')),
+		('GET date (past)', lambda: client.get(f'/{old_date}/')),
+		('GET date events', events),
+		('GET trip', lambda: client.get(f'/trip/{old_trip_id}')),
+		('GET trip ?users', lambda: client.get(f'/trip/{old_trip_id}?users')),
+		('GET settle', lambda: client.get('/settle')),
+		('GET settle ?settled=false', lambda: client.get('/settle?settled=false')),
+		('GET settle ?since', lambda: client.get(f'/settle?since={old_date}')),
+		('GET settle plan', lambda: client.get('/settle/plan')),
+		('GET stats', lambda: client.get(f'/stats?since={old_date.strftime("%Y-%m")}')),
+		('GET metrics', lambda: client.get('/metrics')),
+		('GET status', lambda: client.get('/status')),
+		('POST order', lambda: client.post(f'/trip/{open_trip_id}/order', data=order_form())),
+		('API POST login', lambda: client.post('/api/v1/login', json={'user': buyer, 'pass': 'password'})),
+		('API GET destinations', lambda: client.get('/api/v1/destinations')),
+		('API GET date trips ?counts', lambda: client.get(f'/api/v1/dates/{latest_date}/trips?counts')),
+		('API GET trip counts', lambda: client.get(f'/api/v1/trips/{open_trip_id}/counts')),
+		('API PUT trip counts', lambda: client.put(f'/api/v1/trips/{open_trip_id}/counts', json=api_counts())),
+		('API GET settlement', lambda: client.get('/api/v1/settlement')),
+		('POST settle until', lambda: client.post('/settle', data={'action': 'settle-until', 'until': str(old_date)})),
+	]
+
+	results = {}
+	for name, request in routes:
+		response = request()
+		if response.status_code >= 400:
+			raise RuntimeError(f"{name}: HTTP {response.status_code}")
+		timings = []
+		for _ in range(repeat):
+			statements.clear()
+			start = time.perf_counter()
+			request()
+			timings.append((time.perf_counter() - start) * 1000)
+		queries = len(statements)
+		tracemalloc.start()
+		request()
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		results[name] = {'ms': round(statistics.median(timings), 2), 'queries': queries, 'peak_kib': round(peak / 1024)}
+	return results
+
+
+def run_all(scales, repeat):
+	results = {}
+	with tempfile.TemporaryDirectory() as tmp:
+		for scale in scales:
+			config = os.path.join(tmp, f'{scale}.cfg')
+			with open(config, 'w') as f:
+				f.write('SECRET_KEY = "benchmark"\n')
+				f.write(f'SQLALCHEMY_DATABASE_URI = "sqlite:///{os.path.join(tmp, scale)}.db"\n')
+				f.write('SQLALCHEMY_TRACK_MODIFICATIONS = False\n')
+				# Slow requests are what this is looking for, no need to log them
+				f.write('SLOW_REQUEST_SECONDS = 3600\n')
+				# Event streams end after the missed events instead of waiting for new ones
+				f.write('EVENT_STREAM_SECONDS = 0\n')
+			env = dict(os.environ, NOODLZ_SETTINGS=config, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+			output = subprocess.run([sys.executable, __file__, '--run-scale', scale, '--repeat', str(repeat)], env=env, check=True, stdout=subprocess.PIPE).stdout
+			results[scale] = json.loads(output)
+	return results
+
+
+def compare(baseline, results, latency_tolerance, memory_tolerance):
+	regressions = []
+	for scale, routes in results.items():
+		for name, result in routes.items():
+			base = baseline.get(scale, {}).get(name)
+			if base is None:
+				continue
+			if result['queries'] > base['queries']:
+				regressions.append(f"{scale} / {name}: {result['queries']} SQL statements, baseline {base['queries']}")
+			if result['ms'] > base['ms'] * latency_tolerance and result['ms'] - base['ms'] > 5:
+				regressions.append(f"{scale} / {name}: {result['ms']} ms, baseline {base['ms']} ms")
+			if result['peak_kib'] > base['peak_kib'] * memory_tolerance and result['peak_kib'] - base['peak_kib'] > 256:
+				regressions.append(f"{scale} / {name}: {result['peak_kib']} KiB peak memory, baseline {base['peak_kib']} KiB")
+	return regressions
+
+
+def main():
+	ap = argparse.ArgumentParser(description="Benchmark all routes at several database sizes")
+	ap.add_argument('--scale', action='append', choices=list(SCALES), help="Only run these scales (default: all)")
+	ap.add_argument('--repeat', type=int, default=5, help="Number of timed requests per route")
+	ap.add_argument('--update', action='store_true', default=False, help="Write the results to the baseline file")
+	ap.add_argument('--baseline', default=BASELINE)
+	ap.add_argument('--latency-tolerance', type=float, default=2.0, help="Fail if a route gets slower than this factor of the baseline")
+	ap.add_argument('--memory-tolerance', type=float, default=1.5, help="Fail if a route uses more than this factor of the baseline's peak memory")
+	ap.add_argument('--run-scale', default=None, help=argparse.SUPPRESS)
+	args = ap.parse_args()
+
+	if args.run_scale:
+		json.dump(run_scale(args.run_scale, args.repeat), sys.stdout)
+		return
+
+	results = run_all(args.scale or list(SCALES), args.repeat)
+	for scale, routes in results.items():
+		print(f"{scale}: " + " ".join(f"{key}={value}" for key, value in SCALES[scale].items()))
+		for name, result in routes.items():
+			print(f"    {name:<28} {result['ms']:>9.2f} ms {result['queries']:>5} queries {result['peak_kib']:>7} KiB")
+
+	if args.update:
+		baseline = {}
+		if os.path.exists(args.baseline):
+			with open(args.baseline) as f:
+				baseline = json.load(f)
+		baseline.update(results)
+		with open(args.baseline, 'w') as f:
+			json.dump(baseline, f, indent='\t', sort_keys=True)
+			f.write('\n')
+		print(f"Baseline written to {args.baseline}")
+		return
+
+	if not os.path.exists(args.baseline):
+		print(f"No baseline at {args.baseline}, run with --update first.")
+		sys.exit(1)
+	with open(args.baseline) as f:
+		baseline = json.load(f)
+	regressions = compare(baseline, results, args.latency_tolerance, args.memory_tolerance)
+	if regressions:
+		print(f"\n{len(regressions)} REGRESSIONS:")
+		for regression in regressions:
+			print(f"    {regression}")
+		sys.exit(1)
+	print("\nNo regressions.")
+
+
+if __name__ == '__main__':
+	main()
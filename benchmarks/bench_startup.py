@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''Measures how long it takes until Noodlz can do something: importing the package and the CLI, creating the app, and the first request a fresh worker answers.
+
+	python3 benchmarks/bench_startup.py
+	python3 benchmarks/bench_startup.py --repeat 20
+
+Every measurement runs in a new Python process, so nothing is imported or compiled yet, and reports the median.
+"cold" starts with an empty template bytecode cache (TEMPLATE_CACHE_DIR), "warm" with the one the previous run left behind.'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (code that runs before the clock starts, code that is measured)
+SCENARIOS = {
+	'import noodlz': ('', 'import noodlz'),
+	'import the CLI': ('', 'import noodlz.__main__'),
+	'create_app(web=False)': ('import noodlz', 'noodlz.create_app(web=False)'),
+	'create_app() without warm-up': ('import noodlz; import os; os.environ["NOODLZ_WARM_UP"] = ""', 'noodlz.create_app()'),
+	'create_app() with warm-up': ('import noodlz', 'noodlz.create_app()'),
+	'first request without warm-up': ('import noodlz; import os; os.environ["NOODLZ_WARM_UP"] = ""; app = noodlz.create_app(); client = app.test_client(); client.post("/login", data={"user": "Alice", "pass": "password"})', 'client.get("/1970-01-19/")'),
+	'first request after warm-up': ('import noodlz; app = noodlz.create_app(); client = app.test_client(); client.post("/login", data={"user": "Alice", "pass": "password"})', 'client.get("/1970-01-19/")'),
+}
+
+RUNNER = '''
+import json, os, sys, time
+exec(sys.argv[1])
+start = time.perf_counter()
+exec(sys.argv[2])
+print(json.dumps(time.perf_counter() - start))
+'''
+
+CONFIG = '''
+import os
+SECRET_KEY = "startup"
+SQLALCHEMY_DATABASE_URI = "sqlite:///{db}"
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+BCRYPT_ROUNDS = 4
+TEMPLATE_CACHE_DIR = {cache!r}
+WARM_UP = os.environ.get("NOODLZ_WARM_UP", "1") == "1"
+'''
+
+
+def run(setup, code, env):
+	output = subprocess.run([sys.executable, '-c', RUNNER, setup, code], env=env, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+	return json.loads(output.splitlines()[-1])
+
+
+def main():
+	ap = argparse.ArgumentParser(description="Startup times of the package, the CLI and fresh workers")
+	ap.add_argument('--repeat', type=int, default=5, help="Runs per measurement, the median counts")
+	args = ap.parse_args()
+
+	tmp = tempfile.mkdtemp()
+	cache = os.path.join(tmp, 'templates')
+	config = os.path.join(tmp, 'noodlz.cfg')
+	with open(config, 'w') as f:
+		f.write(CONFIG.format(db=os.path.join(tmp, 'noodlz.db'), cache=cache))
+	env = dict(os.environ, NOODLZ_SETTINGS=config, PYTHONPATH=ROOT)
+	subprocess.run([sys.executable, '-m', 'noodlz', 'createdb', '--testdata'], env=env, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+	print(f"{'':36} {'cold':>10} {'warm':>10}")
+	for name, (setup, code) in SCENARIOS.items():
+		results = {'cold': [], 'warm': []}
+		for _ in range(args.repeat):
+			for cache_state in results:
+				if cache_state == 'cold' and os.path.isdir(cache):
+					for filename in os.listdir(cache):
+						os.remove(os.path.join(cache, filename))
+				results[cache_state].append(run(setup, code, env))
+		print(f"{name:36} {statistics.median(results['cold']) * 1000:7.1f} ms {statistics.median(results['warm']) * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+	main()
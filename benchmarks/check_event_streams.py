@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''Checks that a worker refuses live update streams beyond EVENT_MAX_STREAMS and takes new ones once others close.
+
+	python3 benchmarks/check_event_streams.py
+
+Exits with 1 if a stream beyond the limit isn't refused with a 503, or if closed streams keep counting against it.'''
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAX_STREAMS = 2
+
+
+def check():
+	'''Returns a list of problems, empty if there are none'''
+	from noodlz import create_app
+	from noodlz.models import db, now, User
+	from noodlz.passwords import hash_password
+
+	app = create_app()
+	with app.app_context():
+		db.drop_all()
+		db.create_all()
+		db.session.add(User(name='alice', pass_hash=hash_password('password')))
+		db.session.commit()
+	client = app.test_client()
+	client.post('/login', data={'user': 'alice', 'pass': 'password'})
+	url = f'/{now().isoformat()}/events'
+
+	problems = []
+	streams = [client.get(url) for _ in range(MAX_STREAMS)]
+	if [response.status_code for response in streams] != [200] * MAX_STREAMS:
+		problems.append(f"The first {MAX_STREAMS} streams got {[response.status_code for response in streams]}")
+	refused = client.get(url)
+	if refused.status_code != 503 or 'Retry-After' not in refused.headers:
+		problems.append(f"Stream {MAX_STREAMS + 1} got HTTP {refused.status_code} without a 503 and Retry-After")
+	refused.close()
+
+	# Closed before anything was read from it, like a browser that leaves right away
+	streams.pop().close()
+	response = client.get(url)
+	if response.status_code != 200:
+		problems.append(f"A stream after another one closed got HTTP {response.status_code}")
+	streams.append(response)
+
+	for response in streams:
+		response.get_data()
+		response.close()
+	responses = [client.get(url) for _ in range(MAX_STREAMS)]
+	if [response.status_code for response in responses] != [200] * MAX_STREAMS:
+		problems.append(f"Streams after all of them ended got {[response.status_code for response in responses]}")
+	for response in responses:
+		response.close()
+	return problems
+
+
+def main():
+	tmp = tempfile.mkdtemp()
+	config = os.path.join(tmp, 'noodlz.cfg')
+	with open(config, 'w') as f:
+		f.write('SECRET_KEY = "streams"\n')
+		f.write(f'SQLALCHEMY_DATABASE_URI = "sqlite:///{os.path.join(tmp, "noodlz.db")}"\n')
+		f.write('SQLALCHEMY_TRACK_MODIFICATIONS = False\n')
+		f.write('BCRYPT_ROUNDS = 4\n')
+		f.write(f'EVENT_MAX_STREAMS = {MAX_STREAMS}\n')
+		# Streams that get read end right away
+		f.write('EVENT_STREAM_SECONDS = 0\n')
+	os.environ['NOODLZ_SETTINGS'] = config
+	sys.path.insert(0, ROOT)
+
+	problems = check()
+	for problem in problems:
+		print(f"FAILED: {problem}")
+	if problems:
+		sys.exit(1)
+	print(f"Streams beyond {MAX_STREAMS} are refused until others close.")
+
+
+if __name__ == '__main__':
+	main()
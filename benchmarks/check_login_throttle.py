@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+'''Checks that behind a reverse proxy, failed logins of one client don't throttle another.
+
+	python3 benchmarks/check_login_throttle.py
+
+Both clients reach the app through the same proxy address, with PROXY_HOPS = 1 and their own X-Forwarded-For.
+One of them fails to log in until it gets a 429, then the other one must still be able to log in.
+Exits with 1 if it can't, or if the first client never got throttled.'''
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAX_FAILURES_PER_ADDRESS = 3
+
+
+def check():
+	'''Returns a list of problems, empty if there are none'''
+	from noodlz import create_app
+	from noodlz.models import db, User
+	from noodlz.passwords import hash_password
+
+	app = create_app()
+	with app.app_context():
+		db.drop_all()
+		db.create_all()
+		db.session.add(User(name='alice', pass_hash=hash_password('password')))
+		db.session.commit()
+
+	problems = []
+	attacker = app.test_client()
+	statuses = []
+	# A different name every time, so only the address limit applies
+	for n in range(MAX_FAILURES_PER_ADDRESS + 1):
+		response = attacker.post('/login', data={'user': f'nobody{n}', 'pass': 'wrong'}, headers={'X-Forwarded-For': '203.0.113.1'})
+		statuses.append(response.status_code)
+	if statuses[-1] != 429:
+		problems.append(f"{MAX_FAILURES_PER_ADDRESS + 1} failed logins from one address got {statuses}, expected a 429 at the end")
+
+	response = app.test_client().post('/login', data={'user': 'alice', 'pass': 'password'}, headers={'X-Forwarded-For': '203.0.113.2'})
+	if response.status_code != 302:
+		problems.append(f"The login from another address behind the same proxy got HTTP {response.status_code}")
+	return problems
+
+
+def main():
+	tmp = tempfile.mkdtemp()
+	config = os.path.join(tmp, 'noodlz.cfg')
+	with open(config, 'w') as f:
+		f.write('SECRET_KEY = "throttle"\n')
+		f.write(f'SQLALCHEMY_DATABASE_URI = "sqlite:///{os.path.join(tmp, "noodlz.db")}"\n')
+		f.write('SQLALCHEMY_TRACK_MODIFICATIONS = False\n')
+		f.write('BCRYPT_ROUNDS = 4\n')
+		f.write('PROXY_HOPS = 1\n')
+		f.write(f'LOGIN_MAX_FAILURES_PER_ADDRESS = {MAX_FAILURES_PER_ADDRESS}\n')
+	os.environ['NOODLZ_SETTINGS'] = config
+	sys.path.insert(0, ROOT)
+
+	problems = check()
+	for problem in problems:
+		print(f"FAILED: {problem}")
+	if problems:
+		sys.exit(1)
+	print("Clients behind the proxy are throttled separately.")
+
+
+if __name__ == '__main__':
+	main()
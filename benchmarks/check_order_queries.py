@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''Checks that submitting an order takes the same number of SQL statements no matter how many items it changes.
+
+	python3 benchmarks/check_order_queries.py
+	python3 benchmarks/check_order_queries.py --sizes 1 10 80 200
+
+For every size, a user of its own adds that many items to an open trip, changes all of their counts and removes them again,
+so the statements that insert, update and delete order lines each get counted.
+Exits with 1 if the count of any of these steps depends on the size.'''
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# step -> count every item is set to
+STEPS = {'add': 1, 'change': 2, 'remove': 0}
+
+
+def measure(sizes):
+	'''Returns {step: {size: statements}}'''
+	import sqlalchemy
+	from noodlz import create_app
+	from noodlz.models import db, Balance, Item, Order, Trip, User
+	from noodlz.synthetic import create_synthetic_data
+
+	app = create_app()
+	statements = []
+	with app.app_context():
+		db.drop_all()
+		db.create_all()
+		create_synthetic_data(users=len(sizes) + 1, weeks=1, destinations=1, items_per_destination=2 * max(sizes) + 20)
+		# Without earlier orders nobody has a balance yet, so every first order adds one
+		Order.query.delete()
+		Balance.query.delete()
+		trip = Trip.query.order_by(Trip.id).first()
+		trip.closed = False
+		db.session.commit()
+		# Everyone orders from the same buyer and only items with a price, so every step touches the ledger the same way
+		menu = [item.id for item in Item.query.filter_by(destination_id=trip.destination_id, historical=False).filter(Item.price > 0).order_by(Item.id)]
+		names = [name for name, in db.session.query(User.name).filter(User.id != trip.user_id).order_by(User.id)]
+		trip_id, trip_date = trip.id, trip.date
+		sqlalchemy.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+	if len(menu) < max(sizes):
+		raise RuntimeError(f"The menu only has {len(menu)} items")
+
+	results = {step: {} for step in STEPS}
+	for name, size in zip(names, sizes):
+		client = app.test_client()
+		client.post('/login', data={'user': name, 'pass': 'password'})
+		# Fills the user and catalog caches, like any earlier request of the worker would
+		client.get(f'/{trip_date}/')
+		for step, count in STEPS.items():
+			statements.clear()
+			response = client.post(f'/trip/{trip_id}/order', data={f'item-{item_id}': str(count) for item_id in menu[:size]})
+			if response.status_code != 302:
+				raise RuntimeError(f"{step} with {size} items: HTTP {response.status_code}")
+			results[step][size] = len(statements)
+	return results
+
+
+def main():
+	ap = argparse.ArgumentParser(description="Statements per order submission for different numbers of items")
+	ap.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 80], help="Numbers of submitted items")
+	args = ap.parse_args()
+
+	tmp = tempfile.mkdtemp()
+	config = os.path.join(tmp, 'noodlz.cfg')
+	with open(config, 'w') as f:
+		f.write('SECRET_KEY = "queries"\n')
+		f.write(f'SQLALCHEMY_DATABASE_URI = "sqlite:///{os.path.join(tmp, "noodlz.db")}"\n')
+		f.write('SQLALCHEMY_TRACK_MODIFICATIONS = False\n')
+		f.write('BCRYPT_ROUNDS = 4\n')
+		# No version checks of the user cache in the middle of a step
+		f.write('USER_CACHE_POLL_INTERVAL = 3600\n')
+	os.environ['NOODLZ_SETTINGS'] = config
+	sys.path.insert(0, ROOT)
+
+	results = measure(args.sizes)
+	print(f"{'items':8}" + "".join(f"{size:>8}" for size in args.sizes))
+	failed = []
+	for step, counts in results.items():
+		print(f"{step:8}" + "".join(f"{counts[size]:>8}" for size in args.sizes))
+		if len(set(counts.values())) > 1:
+			failed.append(step)
+	if failed:
+		print(f"FAILED: the statements of {', '.join(failed)} depend on the number of items")
+		sys.exit(1)
+	print("Same number of statements for any number of items.")
+
+
+if __name__ == '__main__':
+	main()
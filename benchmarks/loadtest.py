@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+'''Simulates the Monday lunch rush against a real server over HTTP, to see how many people ordering at once a deployment handles.
+
+	python3 benchmarks/loadtest.py --users 50
+	python3 benchmarks/loadtest.py --users 200 --workers 4 --threads 16 --think 2
+	python3 benchmarks/loadtest.py --url http://127.0.0.1:8000 --users 50   # a server on a database from `createdb --synthetic --users 50`
+
+Without --url, it creates a synthetic database in a temporary directory and starts gunicorn on it, like contrib/aur/noodlz.service
+(or Werkzeug's threaded development server if gunicorn isn't installed, which doesn't say much about production).
+Every simulated user is a thread with its own cookies that behaves like a browser: it logs in, opens the date page with its live updates, and waits a random think time between steps.
+Some of them add a trip, everybody orders and changes their order a few times, then the buyers close their trips, look at the shopping list and settle.
+Pages are requested with the ETag of the last response, like a browser does.
+
+Reports throughput and latency percentiles per route, failed requests by status, and with its own server how often requests waited for or failed on a database lock.
+Exits with 1 if any request failed.'''
+import argparse
+import collections
+import datetime
+import http.cookiejar
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds until a request counts as failed
+TIMEOUT = 60
+# Logins refused with 503 or 429 are tried again after Retry-After, this often
+LOGIN_ATTEMPTS = 10
+
+RE_TRIP = re.compile(r'<section class="trip\s*(closed)?\s*" data-trip="(\d+)">(.*?)</section>', re.S)
+RE_ITEM = re.compile(r'name="item-(\d+)"')
+RE_DESTINATION = re.compile(r'<option value="(\d+)">')
+
+CONFIG = '''
+import logging
+SECRET_KEY = "loadtest"
+SQLALCHEMY_DATABASE_URI = "sqlite:///{db}"
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+BCRYPT_ROUNDS = {rounds}
+TEMPLATE_CACHE_DIR = {cache!r}
+# Waiting for locks is what this is about, not the slow request log
+SLOW_REQUEST_SECONDS = 60
+# Lock retries are logged at INFO
+logging.getLogger("noodlz").setLevel(logging.INFO)
+'''
+
+DEV_SERVER = '''
+import sys
+from werkzeug.serving import run_simple
+from noodlz import create_app
+run_simple("127.0.0.1", int(sys.argv[1]), create_app(), threaded=True)
+'''
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+	'''Redirects are followed by the users themselves, so every request is timed on its own'''
+	def redirect_request(self, *args, **kwargs):
+		return None
+
+
+class Stats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		# route -> [seconds, ...]
+		self.latencies = collections.defaultdict(list)
+		# route -> {status: count}, only failed requests
+		self.failures = collections.defaultdict(collections.Counter)
+		# route -> requests refused with 503 or 429 and tried again
+		self.refused = collections.Counter()
+		self.events = 0
+		self.stream_errors = 0
+
+	def add(self, route, status, seconds):
+		with self.lock:
+			self.latencies[route].append(seconds)
+			if status is None or status >= 400:
+				self.failures[route][status or 'no response'] += 1
+
+
+class Browser:
+	'''One user's cookies, and the pages it has seen with their ETags'''
+	def __init__(self, base, stats):
+		self.base = base
+		self.stats = stats
+		self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+		self.pages = {}
+
+	def request(self, route, path, data=None, refused=()):
+		'''Returns (status, body, headers), status None if there was no response. GET responses that weren't modified return the page seen before.
+		Responses with a status in `refused` are only counted, the caller tries again.'''
+		headers = {}
+		if data is None and path in self.pages:
+			headers['If-None-Match'] = self.pages[path][0]
+		body = urllib.parse.urlencode(data).encode() if data is not None else None
+		start = time.perf_counter()
+		try:
+			with self.opener.open(urllib.request.Request(self.base + path, data=body, headers=headers), timeout=TIMEOUT) as response:
+				status, content, response_headers = response.status, response.read(), response.headers
+		except urllib.error.HTTPError as e:
+			status, content, response_headers = e.code, e.read(), e.headers
+		except OSError:
+			status, content, response_headers = None, b'', {}
+		if status in refused:
+			with self.stats.lock:
+				self.stats.refused[route] += 1
+		else:
+			self.stats.add(route, status, time.perf_counter() - start)
+		content = content.decode('utf-8', 'replace')
+		if status == 304:
+			content = self.pages[path][1]
+		elif status == 200 and data is None and response_headers.get('ETag'):
+			self.pages[path] = (response_headers['ETag'], content)
+		return status, content, response_headers
+
+	def follow(self, route, headers):
+		'''Loads the page a redirect points to, like a browser'''
+		location = headers.get('Location') if headers else None
+		if location:
+			url = urllib.parse.urlsplit(location)
+			return self.request(route, url.path + (f'?{url.query}' if url.query else ''))
+
+	def events(self, path, stop):
+		'''Keeps the live updates of the date page open until `stop` is set, reconnecting after the server ends the stream'''
+		last = None
+		while not stop.is_set():
+			headers = {'Last-Event-ID': last} if last else {}
+			try:
+				with self.opener.open(urllib.request.Request(self.base + path, headers=headers), timeout=TIMEOUT) as response:
+					for line in response:
+						if stop.is_set():
+							return
+						if line.startswith(b'id: '):
+							last = line[4:].strip().decode()
+							with self.stats.lock:
+								self.stats.events += 1
+			except OSError:
+				with self.stats.lock:
+					self.stats.stream_errors += 1
+				stop.wait(1)
+
+
+class User(threading.Thread):
+	def __init__(self, number, name, buyer, args, date, stats, ordered, rng):
+		super().__init__(daemon=True)
+		self.number = number
+		self.name = name
+		self.buyer = buyer
+		self.args = args
+		self.date = date
+		self.stats = stats
+		self.ordered = ordered
+		self.rng = rng
+		self.browser = Browser(args.url, stats)
+		self.stop_events = threading.Event()
+
+	def think(self, scale=1):
+		# Most people click on quickly, some get distracted
+		time.sleep(min(self.rng.expovariate(1 / (self.args.think * scale)), 4 * self.args.think * scale) if self.args.think else 0)
+
+	def date_page(self):
+		return self.browser.request('GET /<date>/', f'/{self.date}/')[1]
+
+	def login(self):
+		for attempt in range(LOGIN_ATTEMPTS):
+			status, _, headers = self.browser.request('POST /login', '/login', {'user': self.name, 'pass': 'password'}, refused=(503, 429) if attempt < LOGIN_ATTEMPTS - 1 else ())
+			if status not in (503, 429):
+				break
+			time.sleep(float(headers.get('Retry-After', 1)) + self.rng.random())
+		return status == 302
+
+	def run(self):
+		try:
+			self.rush()
+		finally:
+			self.stop_events.set()
+
+	def rush(self):
+		# Buyers come first, everybody else over the whole ramp-up
+		time.sleep(self.rng.uniform(0, self.args.ramp / 4 if self.buyer else self.args.ramp))
+		if not self.login():
+			self.ordered.abort()
+			return
+		page = self.date_page()
+		if self.args.streams:
+			threading.Thread(target=self.browser.events, args=(f'/{self.date}/events', self.stop_events), daemon=True).start()
+
+		trip_ids = []
+		if self.buyer:
+			self.think(0.5)
+			destinations = RE_DESTINATION.findall(page)
+			if destinations:
+				status, _, headers = self.browser.request('POST /<date>/', f'/{self.date}/', {'destination': destinations[self.number % len(destinations)]})
+				page = self.browser.follow('GET /<date>/', headers)[1] if status == 302 else self.date_page()
+
+		for _ in range(self.args.changes):
+			trips = {int(trip_id): RE_ITEM.findall(section) for closed, trip_id, section in RE_TRIP.findall(page) if not closed}
+			for _ in range(self.args.polls):
+				if trips:
+					break
+				# Nobody has gone yet, look again in a bit
+				self.think()
+				trips = {int(trip_id): RE_ITEM.findall(section) for closed, trip_id, section in RE_TRIP.findall(self.date_page()) if not closed}
+			if not trips:
+				break
+			self.think()
+			trip_id = self.rng.choice(sorted(trips))
+			trip_ids.append(trip_id)
+			items = self.rng.sample(trips[trip_id], min(len(trips[trip_id]), self.rng.randint(1, 3)))
+			status, _, headers = self.browser.request('POST /trip/<id>/order', f'/trip/{trip_id}/order', {f'item-{item_id}': self.rng.randint(0, 3) for item_id in items})
+			page = self.browser.follow('GET /<date>/', headers)[1] if status == 302 else self.date_page()
+
+		# Buyers close their trips once everyone is done
+		try:
+			self.ordered.wait(timeout=TIMEOUT + self.args.ramp + 10 * self.args.think * (self.args.changes + self.args.polls))
+		except threading.BrokenBarrierError:
+			pass
+		if self.buyer:
+			mine = [int(trip_id) for trip_id in re.findall(r'/trip/(\d+)/close', self.date_page())]
+			for trip_id in mine:
+				status, _, headers = self.browser.request('POST /trip/<id>/close', f'/trip/{trip_id}/close', {})
+				self.browser.follow('GET /<date>/', headers)
+				self.browser.request('GET /trip/<id>', f'/trip/{trip_id}')
+			# Back from the shop, everybody pays
+			self.think(4)
+			status, _, headers = self.browser.request('POST /settle', '/settle', {'action': 'settle-until', 'until': str(self.date)})
+			self.browser.follow('GET /settle', headers)
+		elif trip_ids:
+			self.think(2)
+			self.browser.request('GET /settle', '/settle?settled=false')
+
+
+def percentile(values, p):
+	return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def report(stats, elapsed):
+	requests = sum(len(latencies) for latencies in stats.latencies.values())
+	failed = sum(sum(failures.values()) for failures in stats.failures.values())
+	print(f"{requests} requests in {elapsed:.1f} s, {requests / elapsed:.1f} requests/s, {failed} failed")
+	print(f"{'':24} {'count':>7} {'failed':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+	for route, latencies in sorted(stats.latencies.items()):
+		latencies = sorted(latencies)
+		print(f"{route:24} {len(latencies):7} {sum(stats.failures[route].values()):7}"
+			+ "".join(f" {percentile(latencies, p) * 1000:6.0f} ms" for p in (0.5, 0.95, 0.99, 1)))
+	for route, failures in sorted(stats.failures.items()):
+		if failures:
+			print(f"    {route}: " + ", ".join(f"{count}x {status}" for status, count in sorted(failures.items(), key=str)))
+	for route, count in sorted(stats.refused.items()):
+		print(f"    {route}: {count} refused and tried again")
+	print(f"Live update events received: {stats.events}, broken streams: {stats.stream_errors}")
+	return failed
+
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+def start_server(args, tmp):
+	'''Creates a synthetic database for the users and starts a server on it. Returns (process, log file, environment).'''
+	config = os.path.join(tmp, 'noodlz.cfg')
+	with open(config, 'w') as f:
+		f.write(CONFIG.format(db=os.path.join(tmp, 'noodlz.db'), rounds=args.bcrypt_rounds, cache=os.path.join(tmp, 'templates')))
+	env = dict(os.environ, NOODLZ_SETTINGS=config, PYTHONPATH=ROOT)
+	subprocess.run([sys.executable, '-m', 'noodlz', 'createdb', '--synthetic', '--users', str(args.users), '--weeks', '8', '--destinations', str(max(args.buyers, 1)), '--seed', str(args.seed)],
+		env=env, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+	port = free_port()
+	args.url = f'http://127.0.0.1:{port}'
+	gunicorn = shutil.which('gunicorn')
+	if gunicorn:
+		command = [gunicorn, '--preload', '-w', str(args.workers), '--threads', str(args.threads), '-b', f'127.0.0.1:{port}', 'noodlz:create_app()']
+		print(f"gunicorn with {args.workers} workers and {args.threads} threads each on {args.url}")
+	else:
+		command = [sys.executable, '-c', DEV_SERVER, str(port)]
+		print(f"gunicorn isn't installed, using Werkzeug's development server on {args.url}")
+	log = open(os.path.join(tmp, 'server.log'), 'w+')
+	server = subprocess.Popen(command, env=env, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+	deadline = time.monotonic() + 30
+	while True:
+		try:
+			urllib.request.urlopen(f'{args.url}/status', timeout=1).close()
+			break
+		except OSError:
+			if server.poll() is not None or time.monotonic() > deadline:
+				server.kill()
+				log.seek(0)
+				sys.exit(f"The server didn't start:\n{log.read()}")
+			time.sleep(0.1)
+	return server, log, env
+
+
+def next_monday():
+	today = datetime.date.today()
+	return today + datetime.timedelta(days=7 - today.weekday())
+
+
+def main():
+	ap = argparse.ArgumentParser(description="Load test with simulated users ordering at the same time")
+	ap.add_argument('--users', type=int, default=50, help="Number of simulated users, logged in as user0001 etc.")
+	ap.add_argument('--buyers', type=int, default=None, help="How many of them add a trip (default: one in ten)")
+	ap.add_argument('--changes', type=int, default=3, help="How often every user submits an order")
+	ap.add_argument('--polls', type=int, default=10, help="How often a user looks again if there's no open trip yet")
+	ap.add_argument('--think', type=float, default=3, help="Mean think time between steps in seconds, 0 for none")
+	ap.add_argument('--ramp', type=float, default=30, help="Seconds over which users arrive")
+	ap.add_argument('--no-streams', dest='streams', action='store_false', default=True, help="Don't keep the live updates of the date page open")
+	ap.add_argument('--date', type=datetime.date.fromisoformat, default=None, help="Monday to order on (default: next Monday, which the synthetic history doesn't reach)")
+	ap.add_argument('--url', default=None, help="Test a running server instead of starting one")
+	ap.add_argument('--workers', type=int, default=4, help="gunicorn workers")
+	ap.add_argument('--threads', type=int, default=16, help="Threads per gunicorn worker")
+	ap.add_argument('--bcrypt-rounds', type=int, default=12, help="Cost of the synthetic users' password hashes")
+	ap.add_argument('--seed', type=int, default=0)
+	args = ap.parse_args()
+	if args.buyers is None:
+		args.buyers = max(args.users // 10, 1)
+	date = args.date or next_monday()
+
+	server = log = env = None
+	if args.url is None:
+		server, log, env = start_server(args, tempfile.mkdtemp())
+	args.url = args.url.rstrip('/')
+	sys.path.insert(0, ROOT)
+	from noodlz.synthetic import user_name
+
+	stats = Stats()
+	rng = random.Random(args.seed)
+	ordered = threading.Barrier(args.users)
+	users = [User(number, user_name(number), number <= args.buyers, args, date, stats, ordered, random.Random(rng.random())) for number in range(1, args.users + 1)]
+	print(f"{args.users} users, {args.buyers} of them buying, ordering for {date}")
+	start = time.perf_counter()
+	for user in users:
+		user.start()
+	for user in users:
+		user.join()
+	elapsed = time.perf_counter() - start
+
+	failed = report(stats, elapsed)
+	if server is not None:
+		server.terminate()
+		server.wait()
+		log.seek(0)
+		lines = log.read().splitlines()
+		retries = sum('Database is locked in' in line for line in lines)
+		locked = sum('OperationalError' in line and 'database is locked' in line for line in lines)
+		print(f"Requests that waited for a lock and were retried: {retries}, that failed on a lock: {locked}")
+		ledger = subprocess.run([sys.executable, '-m', 'noodlz', 'ledger', 'verify'], env=env, cwd=ROOT, capture_output=True, text=True)
+		print(ledger.stdout.strip().splitlines()[-1])
+		failed += ledger.returncode != 0
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
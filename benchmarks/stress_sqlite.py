@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''Lets several processes write to the same SQLite database at once, like gunicorn workers during the Monday rush, and checks that no order got lost.
+
+	python3 benchmarks/stress_sqlite.py --workers 8 --orders 100
+	python3 benchmarks/stress_sqlite.py --plain   # without WAL, busy timeout and retries, for comparison
+
+Every worker logs in as its own user and keeps changing its counts on the same open trip, and adds a trip on its own date now and then.
+In the end, the counts in the database have to be the last ones every worker sent, every trip has to exist and the balance ledger has to match the orders.
+Exits with 1 if any request failed or anything is missing.'''
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLAIN_CONFIG = {
+	'SQLITE_JOURNAL_MODE': 'DELETE',
+	'SQLITE_SYNCHRONOUS': 'FULL',
+	'SQLITE_BUSY_TIMEOUT': 0,
+	'SQLITE_LOCK_RETRIES': 0,
+}
+
+
+def setup(workers):
+	from noodlz import create_app
+	from noodlz.models import db, Trip, Item
+	from noodlz.synthetic import create_synthetic_data
+
+	with create_app(web=False).app_context():
+		db.drop_all()
+		db.create_all()
+		create_synthetic_data(users=workers, weeks=1, destinations=1, items_per_destination=20)
+		trip = Trip.query.order_by(Trip.id).first()
+		trip.closed = False
+		db.session.commit()
+		menu = [item.id for item in Item.query.filter_by(destination_id=trip.destination_id, historical=False)]
+		return trip.id, trip.date, menu
+
+
+def work(args):
+	number, trip_id, trip_date, menu, orders, seed = args
+	from noodlz import create_app
+	from noodlz.synthetic import user_name
+
+	app = create_app()
+	rng = random.Random(seed)
+	client = app.test_client()
+	client.post('/login', data={'user': user_name(number), 'pass': 'password'})
+	last_counts = {}
+	failures = 0
+	trip_dates = []
+	for n in range(orders):
+		counts = {item_id: rng.randint(0, 3) for item_id in rng.sample(menu, min(len(menu), 3))}
+		response = client.post(f'/trip/{trip_id}/order', data={f'item-{item_id}': str(count) for item_id, count in counts.items()})
+		if response.status_code == 302:
+			last_counts.update(counts)
+		else:
+			failures += 1
+		if n % 10 == 0:
+			# Mondays after the trip's week, one per worker and round
+			date = trip_date.fromordinal(trip_date.toordinal() + 7 * (number * orders + n + 1))
+			response = client.post(f'/{date}/', data={'destination': '1'})
+			if response.status_code == 302 and 'msg_severity=error' not in response.headers.get('Location', ''):
+				trip_dates.append(date)
+			else:
+				failures += 1
+	return number, last_counts, trip_dates, failures
+
+
+def check(trip_id, results):
+	from noodlz import create_app
+	from noodlz.models import db, Trip, Order, Balance, User, compute_balances
+	from noodlz.synthetic import user_name
+
+	problems = []
+	with create_app(web=False).app_context():
+		for number, last_counts, trip_dates, failures in results:
+			user = User.query.filter_by(name=user_name(number)).first()
+			stored = dict(db.session.query(Order.item_id, db.func.sum(Order.count))
+				.filter(Order.trip_id == trip_id, Order.user_id == user.id)
+				.group_by(Order.item_id))
+			for item_id, count in last_counts.items():
+				if stored.get(item_id, 0) != count:
+					problems.append(f"{user.name}: item {item_id} has {stored.get(item_id, 0)}, last sent {count}")
+			for date in trip_dates:
+				if Trip.query.filter_by(user_id=user.id, date=date).count() != 1:
+					problems.append(f"{user.name}: trip on {date} is missing")
+		ledger = {(b.debtor_id, b.creditor_id): b.amount for b in Balance.query if b.amount != 0}
+		if ledger != {key: amount for key, amount in compute_balances().items() if amount != 0}:
+			problems.append("The balance ledger doesn't match the orders")
+	return problems
+
+
+def main():
+	ap = argparse.ArgumentParser(description="Concurrent writers on one SQLite database")
+	ap.add_argument('--workers', type=int, default=8, help="Number of writing processes")
+	ap.add_argument('--orders', type=int, default=100, help="Order changes per process")
+	ap.add_argument('--plain', action='store_true', default=False, help="Turn off WAL, the busy timeout and retries")
+	ap.add_argument('--seed', type=int, default=0)
+	args = ap.parse_args()
+
+	tmp = tempfile.mkdtemp()
+	config = os.path.join(tmp, 'noodlz.cfg')
+	with open(config, 'w') as f:
+		f.write('SECRET_KEY = "stress"\n')
+		f.write(f'SQLALCHEMY_DATABASE_URI = "sqlite:///{os.path.join(tmp, "noodlz.db")}"\n')
+		f.write('SQLALCHEMY_TRACK_MODIFICATIONS = False\n')
+		# Waiting for locks is expected here
+		f.write('SLOW_REQUEST_SECONDS = 60\n')
+		for key, value in (PLAIN_CONFIG.items() if args.plain else ()):
+			f.write(f'{key} = {value!r}\n')
+	os.environ['NOODLZ_SETTINGS'] = config
+	sys.path.insert(0, ROOT)
+
+	trip_id, trip_date, menu = setup(args.workers)
+	# Fresh processes, so that none of them shares a connection with another
+	start = time.perf_counter()
+	with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+		results = pool.map(work, [(number, trip_id, trip_date, menu, args.orders, args.seed + number) for number in range(1, args.workers + 1)])
+	elapsed = time.perf_counter() - start
+
+	requests = sum(args.orders + (args.orders + 9) // 10 for _ in results)
+	failures = sum(result[3] for result in results)
+	problems = check(trip_id, results)
+	print(f"{args.workers} workers, {requests} requests in {elapsed:.1f} s, {failures} failed requests")
+	for problem in problems[:20]:
+		print(f"    {problem}")
+	if failures or problems:
+		print(f"FAILED: {failures} failed requests, {len(problems)} lost changes")
+		sys.exit(1)
+	print("No lost orders.")
+
+
+if __name__ == '__main__':
+	main()
@@ -1,13 +1,20 @@
 import argparse
+import csv
 import datetime
 import decimal
 import getpass
+import heapq
+import json
+import os
+import sys
+import time
 
+from sqlalchemy.orm import contains_eager, joinedload
 
-from passlib import pwd
-from passlib.hash import bcrypt
-
-from . import db, User, Destination, Item, Trip, Order
+# Only what building the argument parser needs, the commands import the rest themselves
+from . import create_app
+from . import reports
+from .models import db, User, Destination, Item, Trip, Order, ArchivedTrip, ArchivedOrder, Balance, compute_balances, rebuild_balances, settle_orders, parse_date, parse_bool, bump_version
 
 
 def _print_item(item):
@@ -15,21 +22,47 @@ def _print_item(item):
 
 
 def _print_order(o):
-	print(f"id={o.id} trip={o.trip.id} date={o.trip.date} buyer={o.trip.user.name} destination={o.trip.destination.name}    item={o.item.name.split(';')[0]} price={o.item.price}    buyer={o.user.name} paid={o.settled}")
+	print(f"id={o.id} trip={o.trip.id} date={o.trip.date} buyer={o.trip.user.name} destination={o.trip.destination.name}    count={o.count} item={o.item.name.split(';')[0]} price={o.item.price}    buyer={o.user.name} paid={o.settled}")
+
+
+ORDER_FIELDS = ['id', 'trip', 'date', 'buyer', 'destination', 'count', 'item', 'price', 'user', 'paid']
+
+
+def _order_row(o):
+	return {
+		'id': o.id,
+		'trip': o.trip.id,
+		'date': o.trip.date.isoformat(),
+		'buyer': o.trip.user.name,
+		'destination': o.trip.destination.name,
+		'count': o.count,
+		'item': o.item.name.split(';')[0],
+		'price': str(o.item.price),
+		'user': o.user.name,
+		'paid': o.settled,
+	}
 
 
 def createdb(args):
+	from . import migrations
+	from .passwords import hash_password
+
 	db.drop_all()
 	db.create_all()
+	migrations.set_version(len(migrations.STEPS))
+	# ids may now belong to other users and items
+	bump_version('user')
+	bump_version('catalog')
+	db.session.commit()
 	if args.testdata:
 		def add(x):
 			db.session.add(x)
 			return x
 
-		alice = add(User(name="Alice", pass_hash=bcrypt.hash("password")))
-		bob = add(User(name="Bob", pass_hash=bcrypt.hash("password")))
-		carol = add(User(name="Carol", pass_hash=bcrypt.hash("password")))
-		dave = add(User(name="Dave", pass_hash=bcrypt.hash("password")))
+		alice = add(User(name="Alice", pass_hash=hash_password("password")))
+		bob = add(User(name="Bob", pass_hash=hash_password("password")))
+		carol = add(User(name="Carol", pass_hash=hash_password("password")))
+		dave = add(User(name="Dave", pass_hash=hash_password("password")))
 
 		jen_and_berries = add(Destination(name="Jen and Berries"))
 		cakehole = add(Destination(name="Cakehole"))
@@ -72,10 +105,63 @@ def createdb(args):
 
 		add(Order(item=pie, trip=trip5, user=carol, settled=False))
 		add(Order(item=sacher, trip=trip5, user=dave, settled=False))
+		db.session.flush()
+		rebuild_balances()
 		db.session.commit()
+	if args.synthetic:
+		from . import synthetic
+		counts = synthetic.create_synthetic_data(
+			users=args.users,
+			weeks=args.weeks,
+			destinations=args.destinations,
+			items_per_destination=args.items_per_destination,
+			seed=args.seed,
+		)
+		print(" ".join(f"{name}={count}" for name, count in counts.items()))
+
+
+def db_upgrade(args):
+	from . import migrations
+	migrations.upgrade()
+
+
+def db_backup(args):
+	from . import backup
+	target = args.target
+	if os.path.isdir(target):
+		target = os.path.join(target, backup.backup_name())
+	elif args.keep is not None:
+		raise RuntimeError("--keep needs a directory as the target")
+	started = time.perf_counter()
+	restarts = backup.backup(target, vacuum=args.vacuum, pages=args.pages, pause=args.pause)
+	print(f"Backed up to {target} in {time.perf_counter() - started:.1f}s ({os.path.getsize(target) // 1024} KiB{f', restarted {restarts} times' if restarts else ''}).")
+	if args.keep is not None:
+		for path in backup.prune(args.target, args.keep):
+			print(f"Removed {path}")
+
+
+def db_check(args):
+	from . import backup
+	path = args.path or backup.database_path()
+	problems = backup.check(path, quick=args.quick)
+	for problem in problems:
+		print(problem)
+	if problems:
+		print(f"{path} has {len(problems)} problems.")
+		sys.exit(1)
+	print(f"{path} is fine.")
+
+
+def db_restore(args):
+	from . import backup
+	backup.restore(args.source, pages=args.pages, pause=args.pause)
+	print(f"Restored {args.source}, the previous contents are in {backup.database_path()}.pre-restore.")
 
 
 def user_add(args):
+	from passlib import pwd
+	from .passwords import hash_password
+
 	if args.generate:
 		password = pwd.genword(128, charset='ascii_50')
 	else:
@@ -83,9 +169,10 @@ def user_add(args):
 		password_verify = getpass.getpass("Again: ")
 		if password != password_verify:
 			raise RuntimeError("Passwords don't match.")
-	pass_hash = bcrypt.hash(password)
+	pass_hash = hash_password(password)
 	user = User(name=args.name, pass_hash=pass_hash)
 	db.session.add(user)
+	bump_version('user')
 	db.session.commit()
 	print(f"User id: {user.id}")
 
@@ -93,6 +180,7 @@ def user_add(args):
 def destination_add(args):
 	destination = Destination(name=args.name)
 	db.session.add(destination)
+	bump_version('catalog')
 	db.session.commit()
 	print(f"Destination id: {destination.id}")
 
@@ -107,6 +195,7 @@ def item_add(args):
 	destination = Destination.query.filter_by(id=args.destination_id).first()
 	item = Item(name=args.name, destination=destination, price=args.price, tag=args.tag)
 	db.session.add(item)
+	bump_version('catalog')
 	db.session.commit()
 	print(f"Item id: {item.id}")
 
@@ -123,6 +212,7 @@ def _item_remove(item):
 		return
 	item.historical = True
 	db.session.add(item)
+	bump_version('catalog')
 
 def item_remove(args):
 	item = Item.query.filter_by(id=args.item_id).first()
@@ -142,6 +232,7 @@ def item_modify(args):
 	if args.remove_tag:
 		item.tag = None
 	db.session.add(item)
+	bump_version('catalog')
 	db.session.commit()
 
 
@@ -150,14 +241,145 @@ def item_reprice(args):
 	was_historical = item.historical
 	_item_remove(item)
 	item_new = Item(name=item.name, tag=item.tag, price=args.price, destination=item.destination, historical=was_historical)
-	db.session.add(item)
+	db.session.add(item_new)
+	bump_version('catalog')
 	db.session.commit()
 
 
+def _order_query(order_model, trip_model, args):
+	query = order_model.query.join(order_model.trip) \
+		.options(
+			contains_eager(order_model.trip).joinedload(trip_model.user),
+			contains_eager(order_model.trip).joinedload(trip_model.destination),
+			joinedload(order_model.item),
+			joinedload(order_model.user),
+		)
+	if args.since:
+		query = query.filter(trip_model.date >= args.since)
+	if args.until:
+		query = query.filter(trip_model.date <= args.until)
+	if args.user:
+		query = query.filter(order_model.user_id == _get_user(args.user).id)
+	if args.buyer:
+		query = query.filter(trip_model.user_id == _get_user(args.buyer).id)
+	if args.destination:
+		destination = Destination.query.filter_by(name=args.destination).first()
+		if destination is None:
+			raise RuntimeError(f"No such destination: {args.destination}")
+		query = query.filter(trip_model.destination_id == destination.id)
+	if args.settled is not None:
+		query = query.filter(order_model.settled == args.settled)
+	return query.order_by(trip_model.date, order_model.id).yield_per(1000)
+
+
 def order_list(args):
-	orders = Order.query.all()
-	for o in orders:
-		_print_order(o)
+	orders = _order_query(Order, Trip, args)
+	# Archived orders are all settled
+	if args.settled is not False:
+		orders = heapq.merge(_order_query(ArchivedOrder, ArchivedTrip, args), orders, key=lambda o: (o.trip.date, o.id))
+
+	if args.format == 'csv':
+		writer = csv.DictWriter(sys.stdout, fieldnames=ORDER_FIELDS)
+		writer.writeheader()
+		for o in orders:
+			writer.writerow(_order_row(o))
+	elif args.format == 'jsonl':
+		for o in orders:
+			print(json.dumps(_order_row(o)))
+	else:
+		for o in orders:
+			_print_order(o)
+
+
+def _get_user(name):
+	user = User.query.filter_by(name=name).first()
+	if user is None:
+		raise RuntimeError(f"No such user: {name}")
+	return user
+
+
+def order_settle(args):
+	buyer = _get_user(args.buyer)
+	user_id = _get_user(args.user).id if args.user else None
+	changed = settle_orders(buyer.id, user_id=user_id, until=args.until, trip_id=args.trip, settled=not args.unsettle)
+	db.session.commit()
+	print(f"Changed {changed} orders.")
+
+
+def settle_plan(args):
+	from . import settlement
+	transfers, token = settlement.plan()
+	names = dict(db.session.query(User.id, User.name))
+	_write_rows(args, ['debtor', 'creditor', 'amount'], [(names[debtor_id], names[creditor_id], amount) for debtor_id, creditor_id, amount in transfers])
+	if args.format == 'text':
+		print(f"{len(transfers)} transfers instead of {Balance.query.filter(Balance.amount != 0).count()}, plan {token}.", file=sys.stderr)
+	if args.apply:
+		changed = settlement.apply_plan(args.token)
+		if changed is None:
+			raise RuntimeError(f"Something was ordered or settled since plan {args.token} was made, the current plan is {token}.")
+		db.session.commit()
+		print(f"Marked {changed} orders as settled.", file=sys.stderr)
+
+
+def _write_rows(args, columns, rows):
+	if args.format == 'csv':
+		writer = csv.writer(sys.stdout)
+		writer.writerow(columns)
+		writer.writerows(rows)
+	elif args.format == 'jsonl':
+		for row in rows:
+			print(json.dumps(dict(zip(columns, row)), default=str))
+	else:
+		for row in rows:
+			print(" ".join(f"{column}={value}" for column, value in zip(columns, row)))
+
+
+def report_show(args):
+	if args.report == 'debt':
+		_write_rows(args, reports.DEBT_COLUMNS, reports.debt_report())
+		return
+	columns, _, _ = reports.REPORTS[args.report]
+	rows = [[month.strftime('%Y-%m')] + row for month, rows in reports.monthly_report(args.report, args.since, args.until) for row in rows]
+	_write_rows(args, ['month'] + columns, rows)
+
+
+def ledger_rebuild(args):
+	rebuild_balances()
+	db.session.commit()
+	print(f"Ledger rebuilt, {Balance.query.count()} balances.")
+
+
+def ledger_verify(args):
+	expected = compute_balances()
+	actual = {(b.debtor_id, b.creditor_id): b.amount for b in Balance.query.all()}
+	mismatches = 0
+	for key in sorted(set(expected) | set(actual)):
+		if expected.get(key, 0) != actual.get(key, 0):
+			debtor_id, creditor_id = key
+			print(f"debtor={debtor_id} creditor={creditor_id} ledger={actual.get(key, 0)} orders={expected.get(key, 0)}")
+			mismatches += 1
+	if mismatches:
+		print(f"{mismatches} balances don't match the orders, run 'ledger rebuild' to fix them.")
+		sys.exit(1)
+	print("Ledger matches the orders.")
+
+
+def archive_run(args):
+	from . import archive
+	before = args.before or datetime.date.today() - datetime.timedelta(days=args.older_than)
+	dates, trips, orders = archive.archive(before, dry_run=args.dry_run)
+	print(f"{'Would archive' if args.dry_run else 'Archived'} {dates} dates before {before} with {trips} trips and {orders} orders.")
+	if dates and not args.dry_run:
+		print("The database file only shrinks after a VACUUM.")
+
+
+def assets_build(args):
+	from . import assets
+	manifest = assets.build()
+	for name, hashed in manifest.items():
+		print(f"{name} -> {hashed}")
+	print(f"Icons: {', '.join(sorted(assets.used_icons()))}")
+	print(f"Brotli: {'yes' if assets.brotli is not None else 'not installed, only gzip'}")
 
 
 def main():
@@ -167,8 +389,41 @@ def main():
 
 	ap_createdb = ap_commands.add_parser('createdb')
 	ap_createdb.add_argument('--testdata', action='store_true', default=False)
+	ap_createdb.add_argument('--synthetic', action='store_true', default=False, help="Generate a large random history, with users named user0001 etc. and password 'password'")
+	ap_createdb.add_argument('--users', type=int, default=50, help="Number of synthetic users")
+	ap_createdb.add_argument('--weeks', type=int, default=52, help="Number of synthetic Mondays, up to the current week")
+	ap_createdb.add_argument('--destinations', type=int, default=5, help="Number of synthetic destinations")
+	ap_createdb.add_argument('--items-per-destination', type=int, default=20, help="Number of synthetic items per destination")
+	ap_createdb.add_argument('--seed', type=int, default=0, help="Seed for the synthetic data")
 	ap_createdb.set_defaults(func=createdb)
 
+	# Database
+	ap_db = ap_commands.add_parser('db')
+	ap_db.set_defaults(func=lambda *args: ap_db.print_usage())
+	ap_db_commands = ap_db.add_subparsers(dest='db_command', required=True)
+
+	ap_db_upgrade = ap_db_commands.add_parser('upgrade', help="Bring the schema of an existing database up to date, keeping its data")
+	ap_db_upgrade.set_defaults(func=db_upgrade)
+
+	ap_db_backup = ap_db_commands.add_parser('backup', help="Copy the database while the app keeps running, and check the copy")
+	ap_db_backup.add_argument('target', help="File to write, or a directory to write a new timestamped backup to")
+	ap_db_backup.add_argument('--vacuum', action='store_true', default=False, help="Write a compacted snapshot with VACUUM INTO, in one go")
+	ap_db_backup.add_argument('--pages', type=int, default=None, help="Pages copied per step (default: BACKUP_PAGES or 256)")
+	ap_db_backup.add_argument('--pause', type=float, default=None, help="Seconds to wait between steps (default: BACKUP_PAUSE or 0.05)")
+	ap_db_backup.add_argument('--keep', type=int, default=None, help="Remove all but this many of the newest backups in the target directory")
+	ap_db_backup.set_defaults(func=db_backup)
+
+	ap_db_check = ap_db_commands.add_parser('check', help="Run SQLite's integrity and foreign key checks")
+	ap_db_check.add_argument('path', nargs='?', default=None, help="Database file to check (default: the configured database)")
+	ap_db_check.add_argument('--quick', action='store_true', default=False, help="Skip the slower index checks")
+	ap_db_check.set_defaults(func=db_check)
+
+	ap_db_restore = ap_db_commands.add_parser('restore', help="Replace the contents of the database with a backup. Stop the service first.")
+	ap_db_restore.add_argument('source', help="Backup file to restore")
+	ap_db_restore.add_argument('--pages', type=int, default=None, help="Pages per step when saving the current contents first")
+	ap_db_restore.add_argument('--pause', type=float, default=None, help="Seconds between those steps")
+	ap_db_restore.set_defaults(func=db_restore)
+
 	# User
 	ap_user = ap_commands.add_parser('user')
 	ap_user.set_defaults(func=lambda *args: ap_user.print_usage())
@@ -236,10 +491,72 @@ def main():
 
 	# Order List
 	ap_order_list = ap_order_commands.add_parser('list')
+	ap_order_list.add_argument('--since', type=parse_date, default=None, help="Only trips on or after this date (YYYY-MM-DD)")
+	ap_order_list.add_argument('--until', type=parse_date, default=None, help="Only trips on or before this date (YYYY-MM-DD)")
+	ap_order_list.add_argument('--user', default=None, help="Only orders by this user")
+	ap_order_list.add_argument('--buyer', default=None, help="Only trips of this user")
+	ap_order_list.add_argument('--destination', default=None, help="Only trips to this destination (by name)")
+	ap_order_list.add_argument('--settled', type=parse_bool, default=None, help="Only settled (yes) or unsettled (no) orders")
+	ap_order_list.add_argument('--format', choices=['text', 'csv', 'jsonl'], default='text')
 	ap_order_list.set_defaults(func=order_list)
 
+	# Order Settle
+	ap_order_settle = ap_order_commands.add_parser('settle', help="Mark all orders on the trips of a buyer as settled, optionally restricted by user, date or trip.")
+	ap_order_settle.add_argument('buyer', help="Name of the user that bought the orders")
+	ap_order_settle.add_argument('--with', dest='user', default=None, help="Only orders by this user")
+	ap_order_settle.add_argument('--until', type=parse_date, default=None, help="Only trips up to this date (YYYY-MM-DD)")
+	ap_order_settle.add_argument('--trip', type=int, default=None, help="Only this trip")
+	ap_order_settle.add_argument('--unsettle', action='store_true', default=False, help="Mark as unsettled instead")
+	ap_order_settle.set_defaults(func=order_settle)
+
+	# Report
+	ap_report = ap_commands.add_parser('report', help="Statistics per month, aggregated over all orders")
+	ap_report.add_argument('report', choices=list(reports.REPORTS) + ['debt'])
+	ap_report.add_argument('--since', type=reports.parse_month, default=None, help="First month (YYYY-MM)")
+	ap_report.add_argument('--until', type=reports.parse_month, default=None, help="Last month (YYYY-MM)")
+	ap_report.add_argument('--format', choices=['text', 'csv', 'jsonl'], default='text')
+	ap_report.set_defaults(func=report_show)
+
+	# Ledger
+	ap_ledger = ap_commands.add_parser('ledger')
+	ap_ledger.set_defaults(func=lambda *args: ap_ledger.print_usage())
+	ap_ledger_commands = ap_ledger.add_subparsers(dest='ledger_command', required=True)
+
+	ap_ledger_rebuild = ap_ledger_commands.add_parser('rebuild', help="Recompute the balances between users from the unsettled orders")
+	ap_ledger_rebuild.set_defaults(func=ledger_rebuild)
+
+	ap_ledger_verify = ap_ledger_commands.add_parser('verify', help="Check that the balances between users match the unsettled orders")
+	ap_ledger_verify.set_defaults(func=ledger_verify)
+
+	# Settling the whole group
+	ap_settle = ap_commands.add_parser('settle')
+	ap_settle.set_defaults(func=lambda *args: ap_settle.print_usage())
+	ap_settle_commands = ap_settle.add_subparsers(dest='settle_command', required=True)
+
+	ap_settle_plan = ap_settle_commands.add_parser('plan', help="The fewest transfers between users that settle everyone's unsettled balances")
+	ap_settle_plan.add_argument('--apply', action='store_true', default=False, help="Settle all orders behind the balances, once the transfers have been made")
+	ap_settle_plan.add_argument('--token', default=None, help="With --apply, only apply if nothing changed since the plan with this token (shown on /settle/plan) was made")
+	ap_settle_plan.add_argument('--format', choices=['text', 'csv', 'jsonl'], default='text')
+	ap_settle_plan.set_defaults(func=settle_plan)
+
+	# Archive
+	ap_archive = ap_commands.add_parser('archive', help="Move dates whose trips are all closed and settled to the archive tables. Only whole dates are moved, and they can't get new trips afterwards.")
+	ap_archive.add_argument('--before', type=parse_date, default=None, help="Archive dates before this one (YYYY-MM-DD)")
+	ap_archive.add_argument('--older-than', type=int, default=365, help="Archive dates older than this many days, if --before isn't given (default: %(default)s)")
+	ap_archive.add_argument('--dry-run', action='store_true', default=False, help="Only count what would be archived")
+	ap_archive.set_defaults(func=archive_run)
+
+	# Static files
+	ap_assets = ap_commands.add_parser('assets')
+	ap_assets.set_defaults(func=lambda *args: ap_assets.print_usage())
+	ap_assets_commands = ap_assets.add_subparsers(dest='assets_command', required=True)
+
+	ap_assets_build = ap_assets_commands.add_parser('build', help="Write the static files with content hashes, compressed variants and the icon sprite to static/dist")
+	ap_assets_build.set_defaults(func=assets_build)
+
 	args = ap.parse_args()
-	args.func(args)
+	with create_app(web=False).app_context():
+		args.func(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+'''A small JSON API under /api/v1 for clients that don't want to render HTML, e.g. the chat bot.
+It uses the same session cookie as the web pages (log in with POST /api/v1/login), and every GET answers with an ETag.'''
+import decimal
+import functools
+
+from flask import Blueprint, current_app, request, session, g, abort, jsonify
+from werkzeug.exceptions import HTTPException
+
+from .models import db, retry_on_lock, parse_date, trips_on, find_trip, ArchivedTrip, ArchivedOrder, Order, Balance, User
+from .passwords import authenticate
+from .views import get_cached_user, get_catalog, make_etag, conditional, not_modified, set_order_counts
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+@api.errorhandler(HTTPException)
+def api_error(e):
+	response = jsonify(error=e.description)
+	response.status_code = e.code
+	# e.g. Retry-After of 429 and 503
+	for key, value in e.get_headers():
+		if key != 'Content-Type':
+			response.headers[key] = value
+	return response
+
+
+def api_user(f):
+	@functools.wraps(f)
+	def wrapper(*args, **kwargs):
+		g.user = get_cached_user(session['user_id']) if 'user_id' in session else None
+		if g.user is None:
+			abort(401, "Log in with POST /api/v1/login first.")
+		return f(*args, **kwargs)
+	return wrapper
+
+
+def json_body():
+	data = request.get_json(silent=True)
+	if not isinstance(data, dict):
+		abort(400, "Expected a JSON object.")
+	return data
+
+
+def item_json(item):
+	return {
+		'id': item.id,
+		'name': item.name,
+		'options': item.options,
+		'tag': item.tag,
+		'price': item.price_str,
+		'historical': item.historical,
+	}
+
+
+def trip_json(trip):
+	return {
+		'id': trip.id,
+		'date': trip.date.isoformat(),
+		'destination': trip.destination_id,
+		'buyer': trip.user.name,
+		'closed': trip.closed,
+		'version': trip.version,
+	}
+
+
+def user_counts(trip, user_id):
+	order_model = ArchivedOrder if isinstance(trip, ArchivedTrip) else Order
+	query = db.session.query(order_model.item_id, db.func.sum(order_model.count)) \
+		.filter(order_model.trip_id == trip.id, order_model.user_id == user_id) \
+		.group_by(order_model.item_id)
+	return {str(item_id): count for item_id, count in query if count}
+
+
+def trip_etag(trip):
+	return make_etag('api-counts', trip.id, trip.version, g.user)
+
+
+@api.route("/login", methods=['POST'])
+def api_login():
+	data = json_body()
+	name = data.get('user')
+	if not isinstance(name, str) or not current_app.config['RE_USER'].match(name):
+		abort(400, "Invalid username.")
+	user_id = authenticate(name, data.get('pass', ''))
+	if user_id is None:
+		abort(403, "Invalid username or password")
+	session['user_id'] = user_id
+	return jsonify(id=user_id, name=name)
+
+
+@api.route("/destinations")
+@api_user
+def api_destinations():
+	'''All destinations with their menus.'''
+	catalog = get_catalog()
+	etag = make_etag('api-destinations', catalog.version)
+	response = not_modified(etag)
+	if response is not None:
+		return response
+	destinations = [{'id': d.id, 'name': d.name, 'items': [item_json(item) for item in d.items]} for d in catalog.destinations.values()]
+	return conditional(jsonify(destinations=destinations), etag)
+
+
+@api.route("/dates/<date>/trips")
+@api_user
+def api_date_trips(date):
+	'''The trips of a date. With ?counts, each trip includes what the logged in user ordered on it.'''
+	try:
+		date = parse_date(date)
+	except ValueError:
+		abort(400, "Dates look like 1970-01-05.")
+	trips, archived = trips_on(date)
+	with_counts = 'counts' in request.args
+	etag = make_etag('api-trips', date, with_counts, g.user, [(trip.id, trip.version) for trip in trips])
+	last_modified = max((trip.modified for trip in trips if trip.modified is not None), default=None)
+	response = not_modified(etag, last_modified)
+	if response is not None:
+		return response
+	result = [trip_json(trip) for trip in trips]
+	if with_counts:
+		counts = {}
+		order_model = ArchivedOrder if archived else Order
+		query = db.session.query(order_model.trip_id, order_model.item_id, db.func.sum(order_model.count)) \
+			.filter(order_model.trip_id.in_([trip.id for trip in trips]), order_model.user_id == g.user.id) \
+			.group_by(order_model.trip_id, order_model.item_id)
+		for trip_id, item_id, count in query:
+			if count:
+				counts.setdefault(trip_id, {})[str(item_id)] = count
+		for trip in result:
+			trip['counts'] = counts.get(trip['id'], {})
+	return conditional(jsonify(trips=result), etag, last_modified)
+
+
+def get_trip(trip_id):
+	trip = find_trip(trip_id)
+	if trip is None:
+		abort(404, "No such trip.")
+	return trip
+
+
+@api.route("/trips/<int:trip_id>/counts", methods=['GET'])
+@api_user
+def api_trip_counts(trip_id):
+	'''What the logged in user ordered on a trip, as {item id: count}.'''
+	trip = get_trip(trip_id)
+	etag = trip_etag(trip)
+	response = not_modified(etag, trip.modified)
+	if response is not None:
+		return response
+	return conditional(jsonify(trip=trip_json(trip), counts=user_counts(trip, g.user.id)), etag, trip.modified)
+
+
+@api.route("/trips/<int:trip_id>/counts", methods=['PUT'])
+@api_user
+@retry_on_lock
+def api_trip_set_counts(trip_id):
+	'''Sets the counts of the items in {"counts": {item id: count}}. Items that aren't mentioned stay as they are, so repeating a request changes nothing.
+	With If-Match, the request fails with 412 if the trip changed since the client last saw it.'''
+	trip = get_trip(trip_id)
+	if trip.closed:
+		abort(409, "This trip is already closed.")
+	if request.if_match and not request.if_match.contains(trip_etag(trip)):
+		abort(412, "The trip changed in the meantime.")
+	counts = json_body().get('counts')
+	if not isinstance(counts, dict):
+		abort(400, "Expected {\"counts\": {item id: count}}.")
+	try:
+		counts = {int(item_id): int(count) for item_id, count in counts.items()}
+	except (TypeError, ValueError):
+		abort(400, "That's not a number.")
+	set_order_counts(trip, g.user, counts)
+	db.session.commit()
+	return conditional(jsonify(trip=trip_json(trip), counts=user_counts(trip, g.user.id)), trip_etag(trip), trip.modified)
+
+
+@api.route("/settlement")
+@api_user
+def api_settlement():
+	'''Unsettled debt between the logged in user and everyone else, from the balance ledger. Positive amounts are owed to the user.'''
+	net = {}
+	query = db.session.query(Balance.debtor_id, Balance.creditor_id, Balance.amount) \
+		.filter(db.or_(Balance.debtor_id == g.user.id, Balance.creditor_id == g.user.id), Balance.amount != 0)
+	for debtor_id, creditor_id, amount in query:
+		if creditor_id == g.user.id:
+			net[debtor_id] = net.get(debtor_id, 0) + amount
+		else:
+			net[creditor_id] = net.get(creditor_id, 0) - amount
+	names = dict(db.session.query(User.id, User.name).filter(User.id.in_(net))) if net else {}
+	balances = [{'user': names[user_id], 'amount': str(amount)} for user_id, amount in sorted(net.items()) if amount != 0]
+	etag = make_etag('api-settlement', g.user, balances)
+	response = not_modified(etag)
+	if response is not None:
+		return response
+	return conditional(jsonify(
+		owed_to_me=str(sum((amount for amount in net.values() if amount > 0), decimal.Decimal('0.00'))),
+		owed_by_me=str(-sum((amount for amount in net.values() if amount < 0), decimal.Decimal('0.00'))),
+		balances=balances,
+	), etag)
@@ -0,0 +1,62 @@
+'''Moves old dates whose trips are all closed and settled out of the trip and order tables into archived_trip and archived_order.
+Nothing changes about those trips anymore, and this keeps the tables that open trips and settling work on at the size of the recent history.
+Archived trips keep their ids and a summary of their orders; the date, trip and statistics pages read them from the archive tables.'''
+from .models import db, Trip, Order, Item, ArchivedTrip, ArchivedOrder
+
+# Dates moved per transaction, so workers don't wait for the whole archive run
+BATCH_DATES = 20
+
+TRIP_COLUMNS = ['id', 'date', 'closed', 'destination_id', 'user_id', 'version', 'modified']
+ORDER_COLUMNS = ['id', 'count', 'settled', 'item_id', 'trip_id', 'user_id']
+
+
+def archivable_dates(before):
+	'''Dates before `before` on which every trip is closed and every order settled, oldest first.'''
+	open_dates = db.select(Trip.date).where(Trip.closed.is_(False))
+	unsettled_dates = db.select(Trip.date).join(Order, Order.trip_id == Trip.id).where(Order.settled.is_(False))
+	# SQLite gives new rows the largest id in the table plus one, so the newest trip and order have to stay, or their ids would be handed out again
+	newest_trip = db.select(db.func.max(Trip.id)).scalar_subquery()
+	newest_order_trip = db.select(Order.trip_id).where(Order.id == db.select(db.func.max(Order.id)).scalar_subquery()).scalar_subquery()
+	newest_dates = db.select(Trip.date).where(db.or_(Trip.id == newest_trip, Trip.id == newest_order_trip))
+	query = db.session.query(Trip.date) \
+		.filter(Trip.date < before, Trip.date.not_in(open_dates), Trip.date.not_in(unsettled_dates), Trip.date.not_in(newest_dates)) \
+		.distinct() \
+		.order_by(Trip.date)
+	return [date for date, in query]
+
+
+def archive_dates(dates):
+	'''Moves the trips of `dates` and their orders to the archive tables, in the current transaction. Returns (trips, orders) moved.'''
+	trip_ids = db.select(Trip.id).where(Trip.date.in_(dates))
+	summary = db.select(
+		*(getattr(Trip, column) for column in TRIP_COLUMNS),
+		db.func.count(db.distinct(Order.user_id)),
+		db.func.coalesce(db.func.sum(Order.count), 0),
+		db.func.coalesce(db.func.sum(Order.count * Item.price), 0),
+	) \
+		.outerjoin(Order, db.and_(Order.trip_id == Trip.id, Order.count > 0)) \
+		.outerjoin(Item, Order.item_id == Item.id) \
+		.where(Trip.date.in_(dates)) \
+		.group_by(Trip.id)
+	trips = db.session.execute(ArchivedTrip.__table__.insert().from_select(TRIP_COLUMNS + ['users', 'units', 'total'], summary)).rowcount
+	orders = db.select(*(getattr(Order, column) for column in ORDER_COLUMNS)).where(Order.trip_id.in_(trip_ids))
+	db.session.execute(ArchivedOrder.__table__.insert().from_select(ORDER_COLUMNS, orders))
+	orders = Order.query.filter(Order.trip_id.in_(trip_ids)).delete(synchronize_session=False)
+	Trip.query.filter(Trip.date.in_(dates)).delete(synchronize_session=False)
+	return trips, orders
+
+
+def archive(before, dry_run=False):
+	'''Archives all archivable dates before `before`, BATCH_DATES per commit. Returns (dates, trips, orders) archived.'''
+	dates = archivable_dates(before)
+	if dry_run:
+		trips = Trip.query.filter(Trip.date.in_(dates)).count() if dates else 0
+		orders = Order.query.join(Order.trip).filter(Trip.date.in_(dates)).count() if dates else 0
+		return len(dates), trips, orders
+	trips = orders = 0
+	for i in range(0, len(dates), BATCH_DATES):
+		moved_trips, moved_orders = archive_dates(dates[i:i + BATCH_DATES])
+		db.session.commit()
+		trips += moved_trips
+		orders += moved_orders
+	return len(dates), trips, orders
@@ -0,0 +1,163 @@
+'''Static files with a hash of their content in the name, so browsers can keep them forever, and an SVG sprite with only the icons the templates use.
+`noodlz assets build` writes both to static/dist, together with gzip (and brotli, if installed) variants and a manifest.
+Without a build, templates simply get the plain files and a sprite of all icons.'''
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+from flask import current_app, url_for, request, send_from_directory, make_response
+from markupsafe import Markup, escape
+
+from .routing import route
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = os.path.join(DIST_DIR, 'manifest.json')
+ICON_LIBRARY = os.path.join(os.path.dirname(__file__), 'icons.svg')
+SPRITE = 'icons.svg'
+COMPRESS = ('.css', '.js', '.svg', '.ico', '.json')
+SVG_NS = 'http://www.w3.org/2000/svg'
+ICON_CALL = re.compile(r"\bicon\(([^)]*)\)")
+KEYWORD_ARGUMENT = re.compile(r"""\w+\s*=\s*(?:'[^']*'|"[^"]*"|\w+)""")
+STRING = re.compile(r"""'([^']*)'|"([^"]*)\"""")
+ONE_YEAR = 365 * 24 * 60 * 60
+
+ET.register_namespace('', SVG_NS)
+_manifest = None
+
+
+def get_manifest():
+	global _manifest
+	if _manifest is None or current_app.debug:
+		try:
+			with open(MANIFEST) as f:
+				_manifest = json.load(f)
+		except FileNotFoundError:
+			_manifest = {}
+	return _manifest
+
+
+def asset_url(filename):
+	hashed = get_manifest().get(filename)
+	if hashed is not None:
+		return url_for('asset', filename=hashed)
+	if filename == SPRITE:
+		return url_for('icon_sprite')
+	return url_for('static', filename=filename)
+
+
+def icon(name, size=None, fixed=False):
+	classes = ['icon']
+	if size is not None:
+		classes.append(f'icon-{size}')
+	if fixed:
+		classes.append('icon-fw')
+	return Markup(f'<svg class="{" ".join(classes)}" aria-hidden="true"><use href="{escape(asset_url(SPRITE))}#{escape(name)}"></use></svg>')
+
+
+def used_icons():
+	'''Names of all icons in icon() calls of the templates'''
+	names = set()
+	jinja_env = current_app.jinja_env
+	for template in jinja_env.list_templates():
+		source, _, _ = jinja_env.loader.get_source(jinja_env, template)
+		for call in ICON_CALL.finditer(source):
+			arguments = KEYWORD_ARGUMENT.sub('', call.group(1))
+			names.update(single or double for single, double in STRING.findall(arguments))
+	return names
+
+
+def build_sprite(names=None):
+	'''The icon library reduced to `names` (all icons if None)'''
+	library = ET.parse(ICON_LIBRARY).getroot()
+	symbols = {symbol.get('id'): symbol for symbol in library.iter(f'{{{SVG_NS}}}symbol')}
+	missing = set(names or ()) - set(symbols)
+	if missing:
+		raise ValueError(f"Templates use icons that aren't in {ICON_LIBRARY}: {', '.join(sorted(missing))}")
+	sprite = ET.Element(f'{{{SVG_NS}}}svg')
+	for name in sorted(symbols if names is None else names):
+		symbol = symbols[name]
+		symbol.tail = None
+		sprite.append(symbol)
+	return ET.tostring(sprite, encoding='utf-8')
+
+
+def _write(filename, content):
+	path = os.path.join(DIST_DIR, filename)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'wb') as f:
+		f.write(content)
+
+
+def build():
+	'''Write every static file and the icon sprite to static/dist with a content hash in its name. Returns the manifest {name: hashed name}.'''
+	files = {}
+	for root, dirs, filenames in os.walk(STATIC_DIR):
+		dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+		for filename in filenames:
+			path = os.path.join(root, filename)
+			with open(path, 'rb') as f:
+				files[os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')] = f.read()
+	files[SPRITE] = build_sprite(used_icons())
+
+	shutil.rmtree(DIST_DIR, ignore_errors=True)
+	manifest = {}
+	for name, content in sorted(files.items()):
+		base, ext = os.path.splitext(name)
+		hashed = f"{base}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+		_write(hashed, content)
+		if ext in COMPRESS:
+			# mtime=0 keeps the output reproducible
+			compressed = gzip.compress(content, 9, mtime=0)
+			if len(compressed) < len(content):
+				_write(hashed + '.gz', compressed)
+			if brotli is not None:
+				compressed = brotli.compress(content, quality=11)
+				if len(compressed) < len(content):
+					_write(hashed + '.br', compressed)
+		manifest[name] = hashed
+	_write('manifest.json', json.dumps(manifest, indent='\t', sort_keys=True).encode('utf-8'))
+	global _manifest
+	_manifest = manifest
+	return manifest
+
+
+@route("/static/dist/<path:filename>")
+def asset(filename):
+	'''Built files never change under the same name, so they can be cached for good. Sends a precompressed variant if the browser takes it.'''
+	response = None
+	for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+		if request.accept_encodings[encoding] and os.path.isfile(os.path.join(DIST_DIR, filename + suffix)):
+			response = send_from_directory(DIST_DIR, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+			response.content_encoding = encoding
+			break
+	if response is None:
+		response = send_from_directory(DIST_DIR, filename)
+	response.vary.add('Accept-Encoding')
+	response.cache_control.no_cache = None
+	response.cache_control.public = True
+	response.cache_control.max_age = ONE_YEAR
+	response.cache_control.immutable = True
+	return response
+
+
+@route("/icons.svg")
+def icon_sprite():
+	'''All icons, for when the assets aren't built'''
+	response = make_response(build_sprite())
+	response.mimetype = 'image/svg+xml'
+	return response
+
+
+def init_app(app):
+	app.jinja_env.globals.update(asset_url=asset_url, icon=icon)
@@ -0,0 +1,160 @@
+'''Backups of the live SQLite database, while the workers keep writing to it.
+Copying noodlz.db by hand can catch a write half done and misses what is still in the WAL file.
+Instead, SQLite's online backup API copies BACKUP_PAGES pages per step and the copy pauses BACKUP_PAUSE seconds between steps, so order writes get their turn.
+If the database changes during a step, SQLite starts over. After BACKUP_MAX_RESTARTS restarts the rest is copied in one go; with WAL that only holds a read transaction, which doesn't block writers either.
+A compacting snapshot uses VACUUM INTO instead, which leaves out free pages and defragments the copy.
+Every copy is written to a temporary file, checked with PRAGMA integrity_check and only then renamed, so a backup file is always complete.'''
+import datetime
+import os
+import sqlite3
+import time
+
+from flask import current_app
+
+from .models import db, Version
+
+BACKUP_PREFIX = 'noodlz-'
+BACKUP_SUFFIX = '.db'
+
+
+class Restarted(Exception):
+	pass
+
+
+def database_path():
+	url = db.engine.url
+	if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+		raise RuntimeError("Backups only work with an SQLite database file")
+	return url.database
+
+
+def _connect(path):
+	connection = sqlite3.connect(path, isolation_level=None)
+	connection.execute(f"PRAGMA busy_timeout = {int(current_app.config.get('SQLITE_BUSY_TIMEOUT', 5000))}")
+	return connection
+
+
+def check(path, quick=False):
+	'''Returns the problems SQLite finds in the database at `path`, an empty list if there are none'''
+	if not os.path.isfile(path):
+		return [f"{path} doesn't exist"]
+	connection = _connect(path)
+	try:
+		problems = [row[0] for row in connection.execute("PRAGMA quick_check" if quick else "PRAGMA integrity_check") if row[0] != 'ok']
+		problems += [f"{table} row {rowid} refers to a missing row in {parent}" for table, rowid, parent, _ in connection.execute("PRAGMA foreign_key_check")]
+		return problems
+	except sqlite3.DatabaseError as e:
+		return [str(e)]
+	finally:
+		connection.close()
+
+
+def _finish(tmp, target):
+	'''Makes the copy self-contained, checks it and moves it into place'''
+	connection = _connect(tmp)
+	try:
+		connection.execute("PRAGMA journal_mode = DELETE")
+	finally:
+		connection.close()
+	problems = check(tmp)
+	if problems:
+		os.remove(tmp)
+		raise RuntimeError(f"The copy is damaged, the database probably is too: {'; '.join(problems[:10])}")
+	with open(tmp, 'rb') as f:
+		os.fsync(f.fileno())
+	os.replace(tmp, target)
+
+
+def _copy(source, destination, pages, pause, max_restarts):
+	'''Copies with the online backup API, `pages` per step. Returns the number of restarts.'''
+	restarts = 0
+	last = None
+
+	def progress(status, remaining, total):
+		nonlocal restarts, last
+		if last is not None and remaining > last:
+			restarts += 1
+			if restarts > max_restarts:
+				raise Restarted()
+		last = remaining
+		if remaining and pause:
+			time.sleep(pause)
+
+	try:
+		source.backup(destination, pages=pages, progress=progress)
+	except Restarted:
+		source.backup(destination, pages=-1)
+	return restarts
+
+
+def backup(target, vacuum=False, pages=None, pause=None):
+	'''Writes a copy of the live database to `target`. Returns the number of times the copy had to start over.'''
+	if pages is None:
+		pages = int(current_app.config.get('BACKUP_PAGES', 256))
+	if pause is None:
+		pause = float(current_app.config.get('BACKUP_PAUSE', 0.05))
+	tmp = f'{target}.tmp'
+	if os.path.exists(tmp):
+		os.remove(tmp)
+	source = _connect(database_path())
+	try:
+		if vacuum:
+			source.execute("VACUUM INTO ?", (tmp,))
+			restarts = 0
+		else:
+			destination = sqlite3.connect(tmp)
+			try:
+				restarts = _copy(source, destination, pages, pause, int(current_app.config.get('BACKUP_MAX_RESTARTS', 10)))
+			finally:
+				destination.close()
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	finally:
+		source.close()
+	_finish(tmp, target)
+	return restarts
+
+
+def backup_name(when=None):
+	return f'{BACKUP_PREFIX}{(when or datetime.datetime.now()).strftime("%Y%m%d-%H%M%S")}{BACKUP_SUFFIX}'
+
+
+def prune(directory, keep):
+	'''Removes all but the newest `keep` backups in `directory`. Returns the removed paths.'''
+	names = sorted(name for name in os.listdir(directory) if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX))
+	removed = [os.path.join(directory, name) for name in names[:max(len(names) - keep, 0)]]
+	for path in removed:
+		os.remove(path)
+	return removed
+
+
+def restore(source, pages=None, pause=None):
+	'''Replaces the contents of the live database with the backup at `source`, after checking it.
+	The current contents are kept in <database>.pre-restore first.'''
+	problems = check(source)
+	if problems:
+		raise RuntimeError(f"The backup is damaged: {'; '.join(problems[:10])}")
+	path = database_path()
+	backup(f'{path}.pre-restore', pages=pages, pause=pause)
+	versions = dict(db.session.query(Version.name, Version.value))
+	db.session.rollback()
+	db.engine.dispose()
+
+	backup_connection = _connect(source)
+	live = _connect(path)
+	try:
+		backup_connection.backup(live)
+	finally:
+		backup_connection.close()
+		live.close()
+
+	# Workers that keep running must not mistake the restored data for what they have cached
+	for name, value in db.session.query(Version.name, Version.value).all():
+		versions[name] = max(versions.get(name, 0), value)
+	for name, value in versions.items():
+		version = db.session.get(Version, name) or Version(name=name)
+		version.value = value + 1
+		db.session.add(version)
+	db.session.commit()
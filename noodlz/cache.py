@@ -0,0 +1,54 @@
+import collections
+import threading
+import time
+
+
+class Cache:
+	'''A small in-process LRU cache with a time to live for its entries.
+	If `poll_interval` is set, `check_version` drops all entries whenever a version stamp (e.g. from the database) changes, but only looks at the stamp every `poll_interval` seconds.'''
+
+	def __init__(self, maxsize=256, ttl=60, poll_interval=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.poll_interval = poll_interval
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._version = None
+		self._version_checked = None
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None or entry[0] < time.monotonic():
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return entry[1]
+
+	def put(self, key, value):
+		with self._lock:
+			self._entries[key] = (time.monotonic() + self.ttl, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+		return value
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def check_version(self, load_version):
+		now = time.monotonic()
+		if self._version_checked is not None and now - self._version_checked < self.poll_interval:
+			return
+		self._version_checked = now
+		version = load_version()
+		if version != self._version:
+			self.clear()
+			self._version = version
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
@@ -0,0 +1,29 @@
+'''A read-only snapshot of all destinations and items, prepared once so pages don't have to query and parse them again.
+Each worker keeps one snapshot and builds a new one when the 'catalog' version changes (the CLI bumps it whenever it changes destinations or items).'''
+import collections
+import types
+
+# `name` without the options, which are stored after the name separated by ';'
+CatalogItem = collections.namedtuple('CatalogItem', ['id', 'name', 'options', 'tag', 'price', 'price_str', 'historical', 'destination_id'])
+CatalogDestination = collections.namedtuple('CatalogDestination', ['id', 'name', 'items'])
+Catalog = collections.namedtuple('Catalog', ['version', 'destinations', 'items'])
+
+
+def format_price(price):
+	return f"{price:.2f}"
+
+
+def build_catalog(version, destinations, items):
+	'''`destinations` and `items` are the ORM objects. destinations and items of the result map ids to entries, in the order of their ids.'''
+	catalog_items = {}
+	menus = {}
+	for item in sorted(items, key=lambda item: item.id):
+		name, *options = item.name.split(';')
+		entry = CatalogItem(item.id, name, tuple(options), item.tag, item.price, format_price(item.price), item.historical, item.destination_id)
+		catalog_items[item.id] = entry
+		menus.setdefault(item.destination_id, []).append(entry)
+	catalog_destinations = {
+		destination.id: CatalogDestination(destination.id, destination.name, tuple(menus.get(destination.id, ())))
+		for destination in sorted(destinations, key=lambda destination: destination.id)
+	}
+	return Catalog(version, types.MappingProxyType(catalog_destinations), types.MappingProxyType(catalog_items))
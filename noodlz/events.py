@@ -0,0 +1,154 @@
+'''Live updates for the date page as server-sent events.
+Views record changes in the event table (see publish_event), in the same transaction as the change itself, so every worker process sees them.
+One thread per worker polls that table and hands new events to the streams connected to this worker, so the number of queries doesn't grow with the number of browsers.
+Each stream ends after EVENT_STREAM_SECONDS, the browser then reconnects and continues after the last event it saw (Last-Event-ID).
+Streams keep a connection open, so gunicorn should run with threads (e.g. `--threads 16`).
+Only EVENT_MAX_STREAMS of them run at once per worker, fewer than it has threads, so orders and page loads still find a free thread; beyond that the browser gets a 503 and tries again later.'''
+import queue
+import threading
+import time
+
+from flask import current_app, request, make_response, abort
+from werkzeug.exceptions import ServiceUnavailable
+
+from .models import db, parse_date, Event
+from .routing import route
+from .views import require_user
+
+EVENT_KEEPALIVE_SECONDS = 15
+# Retry-After of streams refused for EVENT_MAX_STREAMS
+EVENT_BUSY_SECONDS = 30
+
+
+class EventBroker:
+	def __init__(self, poll_interval=1):
+		self.poll_interval = poll_interval
+		# Polls in an app context of this app, set by init_app
+		self.app = None
+		self._subscribers = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._last_id = None
+		self.max_streams = None
+		self._streams = 0
+
+	def open_stream(self):
+		'''Counts a stream of this worker. Returns False instead if max_streams are already open.'''
+		with self._lock:
+			if self.max_streams is not None and self._streams >= self.max_streams:
+				return False
+			self._streams += 1
+			return True
+
+	def close_stream(self):
+		with self._lock:
+			self._streams -= 1
+
+	def subscribe(self, date):
+		'''Returns a queue that receives (id, kind, data) of all events of `date` from now on. Needs an app context the first time.'''
+		q = queue.Queue()
+		with self._lock:
+			if self._last_id is None:
+				self._last_id = db.session.query(db.func.max(Event.id)).scalar() or 0
+			self._subscribers.setdefault(date, set()).add(q)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='noodlz-events', daemon=True)
+				self._thread.start()
+		return q
+
+	def unsubscribe(self, date, q):
+		with self._lock:
+			subscribers = self._subscribers.get(date, set())
+			subscribers.discard(q)
+			if not subscribers:
+				self._subscribers.pop(date, None)
+
+	def _run(self):
+		while True:
+			time.sleep(self.poll_interval)
+			if not self._subscribers:
+				continue
+			try:
+				with self.app.app_context():
+					events = [(e.id, e.date, e.kind, e.data) for e in Event.query.filter(Event.id > self._last_id).order_by(Event.id)]
+			except Exception:
+				self.app.logger.exception("Polling for events failed")
+				continue
+			with self._lock:
+				for event_id, date, kind, data in events:
+					self._last_id = event_id
+					for q in self._subscribers.get(date, ()):
+						q.put((event_id, kind, data))
+
+
+event_broker = EventBroker()
+
+
+def format_event(event_id, kind, data):
+	return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+
+@route("/<date>/events")
+@require_user
+def date_events(date):
+	try:
+		date = parse_date(date)
+	except ValueError:
+		abort(400, "Dates look like 1970-01-05.")
+	after = request.headers.get('Last-Event-ID', request.args.get('after'))
+	try:
+		after = int(after) if after is not None else None
+	except ValueError:
+		abort(400, "Invalid event id.")
+
+	stream_seconds = float(current_app.config.get('EVENT_STREAM_SECONDS', 120))
+	if not event_broker.open_stream():
+		raise ServiceUnavailable("Too many live updates are open, try again later.", retry_after=EVENT_BUSY_SECONDS)
+	try:
+		# Subscribe before looking up missed events, so nothing falls between the two
+		q = event_broker.subscribe(date)
+		if after is None:
+			backlog = []
+			after = 0
+		else:
+			backlog = [(e.id, e.kind, e.data) for e in Event.query.filter(Event.date == date, Event.id > after).order_by(Event.id)]
+		db.session.close()
+	except BaseException:
+		event_broker.close_stream()
+		raise
+
+	def stream():
+		last = after
+		try:
+			yield f"retry: {int(event_broker.poll_interval * 1000) + 1000}\n\n"
+			for event_id, kind, data in backlog:
+				last = event_id
+				yield format_event(event_id, kind, data)
+			deadline = time.monotonic() + stream_seconds
+			while time.monotonic() < deadline:
+				try:
+					event_id, kind, data = q.get(timeout=min(EVENT_KEEPALIVE_SECONDS, max(deadline - time.monotonic(), 0)))
+				except queue.Empty:
+					yield ": keep-alive\n\n"
+					continue
+				if event_id <= last:
+					continue
+				last = event_id
+				yield format_event(event_id, kind, data)
+		finally:
+			event_broker.unsubscribe(date, q)
+
+	response = make_response(stream())
+	# Also runs if the stream never started
+	response.call_on_close(event_broker.close_stream)
+	response.mimetype = 'text/event-stream'
+	response.cache_control.no_cache = True
+	# Don't let a reverse proxy hold back events
+	response.headers['X-Accel-Buffering'] = 'no'
+	return response
+
+
+def init_app(app):
+	event_broker.app = app
+	event_broker.poll_interval = float(app.config.get('EVENT_POLL_INTERVAL', 1))
+	event_broker.max_streams = int(app.config.get('EVENT_MAX_STREAMS', 8))
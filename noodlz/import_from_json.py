@@ -1,79 +1,224 @@
 import argparse
+import concurrent.futures
 import datetime
+import decimal
+import functools
 import json
-import os.path
+import os
 
+from flask import current_app
 from passlib import pwd
-from passlib.hash import bcrypt
 
-from . import db, User, Destination, Item, Trip, Order
+from . import create_app
+from .models import db, User, Destination, Item, Trip, Order, order_debt, adjust_balances, bump_version
+from .passwords import hash_password
 
 
-def import_from_json(args):
-	'''Transfer from the old JSON format (destinations.json and trips/${DATE}.json)
-	Caution: If anyone ever changed the prices, that would have affected all past orders, settled or unsettled.'''
-	user_cache = {}
-	def get_user(name):
-		if name in user_cache:
-			return user_cache[name]
-		user = User.query.filter_by(name=name).first()
-		if user is not None:
-			return user
-		user_pass = pwd.genword(128, charset='ascii_50')
-		user = User(name=name, pass_hash=bcrypt.hash(user_pass))
-		print(f"Generated user={name} pass={user_pass}")
-		db.session.add(user)
-		return user
+JSON_WHITESPACE = ' \t\n\r'
 
-	dest_cache = {}
-	with open(args.destinations, 'r') as f:
+
+def iter_json_array(f, chunk_size=64 * 1024):
+	'''Yields the elements of the JSON array in file `f` one by one, reading only `chunk_size` characters at a time.'''
+	decoder = json.JSONDecoder()
+	buffer = ''
+	position = 0
+	eof = False
+
+	def fill():
+		nonlocal buffer, position, eof
+		chunk = f.read(chunk_size)
+		if not chunk:
+			eof = True
+		buffer = buffer[position:] + chunk
+		position = 0
+
+	def next_char():
+		nonlocal position
+		while True:
+			while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+				position += 1
+			if position < len(buffer) or eof:
+				return buffer[position:position + 1]
+			fill()
+
+	if next_char() != '[':
+		raise ValueError("Expected a JSON array")
+	position += 1
+	if next_char() == ']':
+		return
+	while True:
+		next_char()
+		while True:
+			try:
+				value, end = decoder.raw_decode(buffer, position)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				fill()
+				continue
+			# A number at the end of the buffer might continue in the next chunk
+			if end == len(buffer) and not eof:
+				fill()
+				continue
+			break
+		position = end
+		yield value
+		c = next_char()
+		if c == ']':
+			return
+		if c != ',':
+			raise ValueError(f"Expected ',' or ']' in JSON array, got {c!r}")
+		position += 1
+
+
+def _item_title(item_name, item_data):
+	item_title = item_data.get("title", item_name)
+	for option in item_data.get("options", []):
+		item_title += ";" + option
+	return item_title
+
+
+def import_destinations(filename):
+	'''Create the destinations and items of destinations.json, reusing those that already exist (e.g. from an earlier, interrupted import).
+	Returns {destination key: {'__dest': Destination, item key: Item}}.'''
+	with open(filename, 'r') as f:
 		destinations = json.load(f)
-		for dest_name, dest_data in destinations.items():
-			dest = Destination(name=dest_data.get("title", dest_name))
+
+	dest_cache = {}
+	for dest_name, dest_data in destinations.items():
+		dest_title = dest_data.get("title", dest_name)
+		dest = Destination.query.filter_by(name=dest_title).first()
+		existing_items = {}
+		if dest is None:
+			dest = Destination(name=dest_title)
 			db.session.add(dest)
-			dest_item_cache = dest_cache[dest_name] = {'__dest': dest}
-			for item_name, item_data in dest_data.get("options", {}).items():
-				item_title = item_data.get("title", item_name)
-				for option in item_data.get("options", []):
-					item_title += ";" + option
+		else:
+			for item in Item.query.filter_by(destination=dest, historical=False):
+				existing_items[(item.name, item.tag, item.price)] = item
+		dest_item_cache = dest_cache[dest_name] = {'__dest': dest}
+		for item_name, item_data in dest_data.get("options", {}).items():
+			item_title = _item_title(item_name, item_data)
+			tag = item_data.get("id", None)
+			price = decimal.Decimal(str(item_data["price"])).quantize(decimal.Decimal('0.01'))
+			item = existing_items.get((item_title, tag, price))
+			if item is None:
 				item = Item(
 					name=item_title,
-					tag=item_data.get("id", None),
+					tag=tag,
 					price=item_data["price"],
 					destination=dest
 				)
 				db.session.add(item)
-				dest_item_cache[item_name] = item
+			dest_item_cache[item_name] = item
+	db.session.flush()
+	return dest_cache
 
-	print(args.trip)
-	for trip_filename in args.trip:
-		with open(trip_filename, 'r') as f:
-			trip_filename_base, _ = os.path.splitext(os.path.basename(trip_filename))
-			trips = json.load(f)
-			for trip_data in trips:
-				trip_dest_cache = dest_cache[trip_data["destination"]]
-				trip = Trip(
-					date=datetime.datetime.strptime(trip_filename_base, '%Y-%m-%d').date(),
-					closed=trip_data.get("closed", False),
-					destination=trip_dest_cache["__dest"],
-					user=get_user(trip_data["user"])
-				)
-				db.session.add(trip)
-				for order_data in trip_data.get("orders", []):
-					order = Order(
-						settled=order_data.get("paid", False),
-						item=trip_dest_cache[order_data["order"]],
-						trip=trip,
-						user=get_user(order_data["user"])
-					)
-					db.session.add(order)
+
+class Importer:
+	'''Imports trips in batches. Every batch is committed on its own, and trips that already exist are skipped, so an interrupted import can simply be run again.'''
+
+	def __init__(self, dest_cache, pool, batch_size):
+		self.dest_cache = dest_cache
+		self.pool = pool
+		self.batch_size = batch_size
+		# The pool's processes have no app context to read it from
+		self.rounds = int(current_app.config.get('BCRYPT_ROUNDS', 12))
+		self.user_cache = {user.name: user for user in User.query.all()}
+		self.existing_trips = set()
+		self.batch = []
+		self.imported = 0
+		self.skipped = 0
+
+	def add_trip(self, date, trip_data):
+		self.batch.append((date, trip_data))
+		if len(self.batch) >= self.batch_size:
+			self.flush()
+
+	def load_existing_trips(self, date):
+		for user_id, destination_id in db.session.query(Trip.user_id, Trip.destination_id).filter_by(date=date):
+			self.existing_trips.add((user_id, date, destination_id))
+
+	def create_users(self):
+		names = set()
+		for date, trip_data in self.batch:
+			names.add(trip_data["user"])
+			names.update(order_data["user"] for order_data in trip_data.get("orders", []))
+		new_names = sorted(names - set(self.user_cache))
+		if not new_names:
+			return
+		passwords = [pwd.genword(128, charset='ascii_50') for name in new_names]
+		for name, password, pass_hash in zip(new_names, passwords, self.pool.map(functools.partial(hash_password, rounds=self.rounds), passwords)):
+			user = User(name=name, pass_hash=pass_hash)
+			print(f"Generated user={name} pass={password}")
+			db.session.add(user)
+			self.user_cache[name] = user
+		db.session.flush()
+		bump_version('user')
+
+	def flush(self):
+		if not self.batch:
+			return
+		self.create_users()
+		debts = {}
+		for date, trip_data in self.batch:
+			trip_dest_cache = self.dest_cache[trip_data["destination"]]
+			trip_user = self.user_cache[trip_data["user"]]
+			key = (trip_user.id, date, trip_dest_cache["__dest"].id)
+			if key in self.existing_trips:
+				self.skipped += 1
+				continue
+			self.existing_trips.add(key)
+			trip = Trip(
+				date=date,
+				closed=trip_data.get("closed", False),
+				destination=trip_dest_cache["__dest"],
+				user=trip_user,
+			)
+			db.session.add(trip)
+			# The old format has one entry per unit, merge them into order lines
+			trip_lines = {}
+			for order_data in trip_data.get("orders", []):
+				line_key = (order_data["order"], order_data["user"], order_data.get("paid", False))
+				trip_lines[line_key] = trip_lines.get(line_key, 0) + 1
+			for (item_name, user_name, paid), count in trip_lines.items():
+				item = trip_dest_cache[item_name]
+				user = self.user_cache[user_name]
+				db.session.add(Order(count=count, settled=paid, item=item, trip=trip, user=user))
+				debt_key = (user.id, trip_user.id)
+				debts[debt_key] = debts.get(debt_key, 0) + order_debt(count, item.price, paid, user.id, trip_user.id)
+			self.imported += 1
+		adjust_balances(debts)
+		db.session.commit()
+		print(f"Imported {self.imported} trips, skipped {self.skipped} existing trips.")
+		self.batch = []
+
+
+def import_from_json(args):
+	'''Transfer from the old JSON format (destinations.json and trips/${DATE}.json)
+	Caution: If anyone ever changed the prices, that would have affected all past orders, settled or unsettled.'''
+	dest_cache = import_destinations(args.destinations)
+	bump_version('catalog')
 	db.session.commit()
 
+	with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+		importer = Importer(dest_cache, pool, args.batch_size)
+		for trip_filename in args.trip:
+			trip_filename_base, _ = os.path.splitext(os.path.basename(trip_filename))
+			date = datetime.datetime.strptime(trip_filename_base, '%Y-%m-%d').date()
+			importer.load_existing_trips(date)
+			with open(trip_filename, 'r') as f:
+				for trip_data in iter_json_array(f):
+					importer.add_trip(date, trip_data)
+		importer.flush()
+
 
 def main():
-	ap = argparse.ArgumentParser(help="Migrate from the old JSON format")
+	ap = argparse.ArgumentParser(description="Migrate from the old JSON format")
 	ap.add_argument('destinations', help="destinations.json")
 	ap.add_argument('trip', nargs='*', help="any number of trip json files")
+	ap.add_argument('--batch-size', type=int, default=100, help="Number of trips to commit at once")
+	ap.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of processes for hashing generated passwords")
 	args = ap.parse_args()
 
-	import_from_json(args)
+	with create_app(web=False).app_context():
+		import_from_json(args)
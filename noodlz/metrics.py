@@ -0,0 +1,339 @@
+'''Request instrumentation: wall time, SQL statements and template rendering per endpoint, a log of slow requests, and /metrics in the Prometheus text format.
+Every gunicorn worker counts on its own. With more than one worker, set METRICS_DIR to a directory all of them can write to:
+each worker dumps its numbers there every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files of all workers.
+The counters of workers that exited are moved into one file when /metrics is collected, so the directory doesn't grow with every restart and the totals never go down.'''
+import atexit
+import fcntl
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import current_app, g, request, abort, make_response, has_request_context
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import __version__
+from .routing import route
+from .views import fullpath, user_cache, fragment_cache
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Set by init_app from the configuration
+SLOW_REQUEST_SECONDS = 1
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+# Statements kept per request for the slow request log
+MAX_STATEMENTS = 200
+CACHES = {'user': user_cache, 'fragment': fragment_cache}
+# Counters of exited workers in METRICS_DIR, and the lock for moving them there
+RETIRED_FILE = 'retired.json'
+LOCK_FILE = '.lock'
+# Temporary files of a flush that never finished are removed after this many seconds
+STALE_TMP_SECONDS = 3600
+
+_lock = threading.Lock()
+# (name, ((label, value), ...)) -> value
+_counters = {}
+# endpoint -> [count per bucket..., count, sum]
+_durations = {}
+_flushed = 0
+# (pid, file name) of this worker in METRICS_DIR. The OS reuses pids, so the name is random; workers forked from a preloaded master pick their own.
+_file = (None, None)
+
+
+def _inc(name, value=1, **labels):
+	key = (name, tuple(sorted(labels.items())))
+	_counters[key] = _counters.get(key, 0) + value
+
+
+def _observe(endpoint, seconds):
+	histogram = _durations.setdefault(endpoint, [0] * (len(BUCKETS) + 2))
+	for i, bound in enumerate(BUCKETS):
+		if seconds <= bound:
+			histogram[i] += 1
+	histogram[-2] += 1
+	histogram[-1] += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	duration = time.perf_counter() - conn.info['query_start'].pop()
+	if has_request_context() and 'metrics' in g:
+		g.metrics['sql_count'] += 1
+		g.metrics['sql_time'] += duration
+		if len(g.metrics['statements']) < MAX_STATEMENTS:
+			g.metrics['statements'].append((duration, statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+	if context.connection is not None and context.connection.info.get('query_start'):
+		context.connection.info['query_start'].pop()
+
+
+def _before_render_template(sender, template, context, **extra):
+	if 'metrics' in g:
+		g.metrics['template_start'].append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+	if 'metrics' in g and g.metrics['template_start']:
+		start = g.metrics['template_start'].pop()
+		# Templates rendered while rendering another one are already part of its time
+		if not g.metrics['template_start']:
+			g.metrics['template_time'] += time.perf_counter() - start
+
+
+def _start_request():
+	g.metrics = {
+		'start': time.perf_counter(),
+		'status': 500,
+		'sql_count': 0,
+		'sql_time': 0.0,
+		'template_start': [],
+		'template_time': 0.0,
+		'statements': [],
+	}
+
+
+def _record_status(response):
+	if 'metrics' in g:
+		g.metrics['status'] = response.status_code
+	return response
+
+
+def _finish_request(exc):
+	if 'metrics' not in g:
+		return
+	m = g.pop('metrics')
+	duration = time.perf_counter() - m['start']
+	endpoint = request.endpoint or 'none'
+	with _lock:
+		_inc('noodlz_requests_total', endpoint=endpoint, method=request.method, status=str(m['status']))
+		_observe(endpoint, duration)
+		_inc('noodlz_sql_statements_total', m['sql_count'], endpoint=endpoint)
+		_inc('noodlz_sql_duration_seconds_total', m['sql_time'], endpoint=endpoint)
+		_inc('noodlz_template_duration_seconds_total', m['template_time'], endpoint=endpoint)
+		if duration >= SLOW_REQUEST_SECONDS:
+			_inc('noodlz_slow_requests_total', endpoint=endpoint)
+	if duration >= SLOW_REQUEST_SECONDS:
+		slowest = sorted(m['statements'], key=lambda s: s[0], reverse=True)[:10]
+		current_app.logger.warning(
+			"Slow request %s %s took %.3f s: %d SQL statements in %.3f s, templates in %.3f s. Slowest statements:\n%s",
+			request.method, fullpath(request), duration, m['sql_count'], m['sql_time'], m['template_time'],
+			"\n".join(f"{seconds:.3f} s: {' '.join(statement.split())[:500]}" for seconds, statement in slowest))
+	if METRICS_DIR is not None and time.monotonic() - _flushed >= METRICS_FLUSH_INTERVAL:
+		flush()
+
+
+def snapshot():
+	with _lock:
+		counters = [[name, list(labels), value] for (name, labels), value in _counters.items()]
+		durations = {endpoint: list(histogram) for endpoint, histogram in _durations.items()}
+	gauges = []
+	for cache_name, cache in CACHES.items():
+		stats = cache.stats()
+		counters.append(['noodlz_cache_hits_total', [['cache', cache_name]], stats['hits']])
+		counters.append(['noodlz_cache_misses_total', [['cache', cache_name]], stats['misses']])
+		gauges.append(['noodlz_cache_entries', [['cache', cache_name]], stats['size']])
+	return {'counters': counters, 'durations': durations, 'gauges': gauges}
+
+
+def worker_file():
+	global _file
+	if _file[0] != os.getpid():
+		_file = (os.getpid(), f'{os.getpid()}-{uuid.uuid4().hex}.json')
+	return _file[1]
+
+
+def _write(filename, data):
+	'''Replaces the file atomically, so /metrics never reads half of it'''
+	fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, prefix='.tmp-')
+	with os.fdopen(fd, 'w') as f:
+		json.dump(data, f)
+	os.replace(tmp, os.path.join(METRICS_DIR, filename))
+
+
+def _read(filename):
+	try:
+		with open(os.path.join(METRICS_DIR, filename)) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+def flush():
+	'''Write this worker's numbers to METRICS_DIR'''
+	global _flushed
+	_flushed = time.monotonic()
+	os.makedirs(METRICS_DIR, exist_ok=True)
+	_write(worker_file(), snapshot())
+
+
+def _alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+
+def _add(total, snap):
+	'''Adds the counters and durations of `snap` to `total`'''
+	counters = {(name, tuple(map(tuple, labels))): value for name, labels, value in total['counters']}
+	for name, labels, value in snap['counters']:
+		key = (name, tuple(map(tuple, labels)))
+		counters[key] = counters.get(key, 0) + value
+	total['counters'] = [[name, list(labels), value] for (name, labels), value in counters.items()]
+	for endpoint, histogram in snap['durations'].items():
+		histogram_total = total['durations'].setdefault(endpoint, [0] * len(histogram))
+		for i, value in enumerate(histogram):
+			histogram_total[i] += value
+
+
+def _retire(filenames):
+	'''Adds the counters of exited workers to RETIRED_FILE and removes their files.
+	The retired file remembers which files it contains, so a file is never counted twice, even if removing it failed.'''
+	with open(os.path.join(METRICS_DIR, LOCK_FILE), 'a') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		retired = _read(RETIRED_FILE) or {'counters': [], 'durations': {}, 'gauges': [], 'files': []}
+		retired['files'] = [filename for filename in retired['files'] if os.path.exists(os.path.join(METRICS_DIR, filename))]
+		for filename in filenames:
+			if filename in retired['files']:
+				continue
+			snap = _read(filename)
+			if snap is None:
+				continue
+			_add(retired, snap)
+			retired['files'].append(filename)
+		_write(RETIRED_FILE, retired)
+		for filename in filenames:
+			try:
+				os.remove(os.path.join(METRICS_DIR, filename))
+			except FileNotFoundError:
+				pass
+	return retired
+
+
+def collect():
+	'''Returns the snapshots of all workers, {pid: snapshot}, with the counters of workers that exited under None.'''
+	snapshots = {os.getpid(): snapshot()}
+	if METRICS_DIR is None or not os.path.isdir(METRICS_DIR):
+		return snapshots
+	# pid -> [(modified, file name)]
+	files = {}
+	for filename in os.listdir(METRICS_DIR):
+		path = os.path.join(METRICS_DIR, filename)
+		if filename.startswith('.tmp-'):
+			try:
+				if time.time() - os.path.getmtime(path) > STALE_TMP_SECONDS:
+					os.remove(path)
+			except FileNotFoundError:
+				pass
+			continue
+		name, ext = os.path.splitext(filename)
+		pid = name.split('-')[0]
+		if ext != '.json' or not pid.isdigit() or filename == worker_file():
+			continue
+		try:
+			files.setdefault(int(pid), []).append((os.path.getmtime(path), filename))
+		except FileNotFoundError:
+			continue
+
+	dead = []
+	for pid, pid_files in files.items():
+		pid_files.sort()
+		# Older files of a reused pid belong to workers that exited
+		dead += [filename for _, filename in pid_files[:-1]]
+		if pid == os.getpid() or not _alive(pid):
+			dead.append(pid_files[-1][1])
+		else:
+			snap = _read(pid_files[-1][1])
+			if snap is not None:
+				snapshots[pid] = snap
+	snapshots[None] = _retire(dead) if dead else _read(RETIRED_FILE)
+	if snapshots[None] is None:
+		del snapshots[None]
+	return snapshots
+
+
+def _labels(labels):
+	if not labels:
+		return ''
+	escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+	return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render(snapshots):
+	counters = {}
+	gauges = {}
+	durations = {}
+	for pid, snap in snapshots.items():
+		for name, labels, value in snap['counters']:
+			key = (name, tuple(map(tuple, labels)))
+			counters[key] = counters.get(key, 0) + value
+		if pid is not None:
+			for name, labels, value in snap['gauges']:
+				key = (name, tuple(map(tuple, labels)))
+				gauges[key] = gauges.get(key, 0) + value
+		for endpoint, histogram in snap['durations'].items():
+			total = durations.setdefault(endpoint, [0] * len(histogram))
+			for i, value in enumerate(histogram):
+				total[i] += value
+
+	lines = [
+		'# TYPE noodlz_info gauge',
+		f'noodlz_info{_labels([("version", __version__)])} 1',
+		'# TYPE noodlz_workers gauge',
+		f'noodlz_workers {sum(1 for pid in snapshots if pid is not None)}',
+	]
+	for kind, values in (('counter', counters), ('gauge', gauges)):
+		last_name = None
+		for (name, labels), value in sorted(values.items()):
+			if name != last_name:
+				lines.append(f'# TYPE {name} {kind}')
+				last_name = name
+			lines.append(f'{name}{_labels(labels)} {value}')
+	lines.append('# TYPE noodlz_request_duration_seconds histogram')
+	for endpoint, histogram in sorted(durations.items()):
+		for bound, count in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+			lines.append(f'noodlz_request_duration_seconds_bucket{_labels([("endpoint", endpoint), ("le", bound)])} {count}')
+		lines.append(f'noodlz_request_duration_seconds_sum{_labels([("endpoint", endpoint)])} {histogram[-1]}')
+		lines.append(f'noodlz_request_duration_seconds_count{_labels([("endpoint", endpoint)])} {histogram[-2]}')
+	return '\n'.join(lines) + '\n'
+
+
+@route("/metrics", methods=['GET'])
+def metrics():
+	token = current_app.config.get('METRICS_TOKEN')
+	if token is not None and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+		abort(403)
+	response = make_response(render(collect()))
+	response.mimetype = 'text/plain'
+	response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+	return response
+
+
+def init_app(app):
+	global SLOW_REQUEST_SECONDS, METRICS_DIR, METRICS_FLUSH_INTERVAL
+	SLOW_REQUEST_SECONDS = float(app.config.get('SLOW_REQUEST_SECONDS', 1))
+	METRICS_DIR = app.config.get('METRICS_DIR')
+	METRICS_FLUSH_INTERVAL = float(app.config.get('METRICS_FLUSH_INTERVAL', 5))
+	before_render_template.connect(_before_render_template, app)
+	template_rendered.connect(_template_rendered, app)
+	app.before_request(_start_request)
+	app.after_request(_record_status)
+	app.teardown_request(_finish_request)
+	if METRICS_DIR is not None:
+		atexit.register(flush)
@@ -0,0 +1,83 @@
+'''Upgrades the schema of an existing SQLite database in place.
+Every step runs once, the number of applied steps is kept in SQLite's `user_version` pragma.'''
+import sqlalchemy
+
+from . import reports
+from .models import db, Trip, Order, Balance, rebuild_balances
+
+
+def _add_column(table, name, definition):
+	columns = [c['name'] for c in sqlalchemy.inspect(db.session.connection()).get_columns(table.name)]
+	if name not in columns:
+		db.session.execute(sqlalchemy.text(f'ALTER TABLE "{table.name}" ADD COLUMN {name} {definition}'))
+
+
+def collapse_orders():
+	'''Store orders as lines with a count instead of one row per unit'''
+	_add_column(Order.__table__, 'count', 'INTEGER NOT NULL DEFAULT 1')
+
+	key = (Order.trip_id, Order.item_id, Order.user_id, Order.settled)
+	groups = db.session.query(*key, db.func.min(Order.id), db.func.sum(Order.count), db.func.count(Order.id)) \
+		.group_by(*key) \
+		.having(db.func.count(Order.id) > 1) \
+		.all()
+	for trip_id, item_id, user_id, settled, keep_id, total, rows in groups:
+		Order.query.filter_by(id=keep_id).update({'count': total}, synchronize_session=False)
+		Order.query.filter_by(trip_id=trip_id, item_id=item_id, user_id=user_id, settled=settled) \
+			.filter(Order.id != keep_id) \
+			.delete(synchronize_session=False)
+
+
+def create_ledger():
+	'''Add the balance ledger'''
+	Balance.__table__.create(db.session.connection(), checkfirst=True)
+	rebuild_balances()
+
+
+def add_trip_version():
+	'''Track the version and modification time of trips'''
+	_add_column(Trip.__table__, 'version', 'INTEGER NOT NULL DEFAULT 1')
+	_add_column(Trip.__table__, 'modified', 'DATETIME')
+
+
+def add_report_trips():
+	'''Recompute cached reports when the trips of their month change'''
+	reports.ReportCache.__table__.create(db.session.connection(), checkfirst=True)
+	_add_column(reports.ReportCache.__table__, 'trips', "VARCHAR(64) NOT NULL DEFAULT ''")
+
+
+STEPS = [
+	collapse_orders,
+	create_ledger,
+	add_trip_version,
+	add_report_trips,
+]
+
+
+def get_version():
+	return db.session.execute(sqlalchemy.text('PRAGMA user_version')).scalar()
+
+
+def set_version(version):
+	db.session.execute(sqlalchemy.text(f'PRAGMA user_version = {int(version)}'))
+
+
+def create_missing():
+	'''Create tables and indexes that are declared in the models but missing from the database.'''
+	connection = db.session.connection()
+	for table in db.metadata.sorted_tables:
+		table.create(connection, checkfirst=True)
+		for index in table.indexes:
+			index.create(connection, checkfirst=True)
+
+
+def upgrade():
+	version = get_version()
+	for number, step in enumerate(STEPS[version:], version + 1):
+		print(f"Step {number}: {step.__doc__}")
+		step()
+		set_version(number)
+		db.session.commit()
+	create_missing()
+	db.session.commit()
+	print(f"Database is at version {len(STEPS)}.")
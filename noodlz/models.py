@@ -0,0 +1,342 @@
+'''The database: tables, the SQLite setup for several workers, and the helpers that keep orders, the balance ledger and versions consistent.
+Doesn't need the web app, so the CLI can use it on its own (in an app context).'''
+import datetime
+import functools
+import json
+import random
+import sqlite3
+import time
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy.event
+import sqlalchemy.exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload
+
+db = SQLAlchemy()
+
+
+@sqlalchemy.event.listens_for(Engine, 'connect')
+def sqlite_pragmas(dbapi_connection, connection_record):
+	'''Let several gunicorn workers share the SQLite database: with WAL, readers don't block the writer and the other way round,
+	and a writer waits up to SQLITE_BUSY_TIMEOUT milliseconds for another one instead of failing right away.'''
+	if not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+	config = current_app.config if has_app_context() else {}
+	cursor = dbapi_connection.cursor()
+	cursor.execute(f"PRAGMA busy_timeout = {int(config.get('SQLITE_BUSY_TIMEOUT', 5000))}")
+	journal_mode = config.get('SQLITE_JOURNAL_MODE', 'WAL')
+	if journal_mode is not None:
+		cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+	# NORMAL is safe with WAL, a power loss can only undo the latest commits
+	synchronous = config.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+	if synchronous is not None:
+		cursor.execute(f"PRAGMA synchronous = {synchronous}")
+	cursor.close()
+
+
+def is_locked(e):
+	return isinstance(e.orig, sqlite3.OperationalError) and ('database is locked' in str(e.orig) or 'database table is locked' in str(e.orig))
+
+
+def retry_on_lock(f):
+	'''Runs a view that writes again, in a new transaction, when SQLite still reports a lock after the busy timeout.
+	Waits a random time between attempts, up to SQLITE_LOCK_BACKOFF seconds doubled per attempt, at most SQLITE_LOCK_RETRIES times.'''
+	@functools.wraps(f)
+	def wrapper(*args, **kwargs):
+		retries = int(current_app.config.get('SQLITE_LOCK_RETRIES', 5))
+		backoff = float(current_app.config.get('SQLITE_LOCK_BACKOFF', 0.05))
+		for attempt in range(retries + 1):
+			try:
+				return f(*args, **kwargs)
+			except sqlalchemy.exc.OperationalError as e:
+				db.session.rollback()
+				if not is_locked(e) or attempt == retries:
+					raise
+				current_app.logger.info("Database is locked in %s, attempt %d of %d", f.__name__, attempt + 1, retries + 1)
+				time.sleep(random.uniform(0, backoff * 2 ** attempt))
+	return wrapper
+
+
+class User(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(32), unique=True, nullable=False)
+	pass_hash = db.Column(db.String(128), nullable=False)
+
+
+class Destination(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(128), unique=True, nullable=False)
+
+
+class Item(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.Text(), nullable=False)
+	tag = db.Column(db.String(16), default=None, nullable=True)
+	price = db.Column(db.Numeric(9, scale=2), nullable=False)
+	historical = db.Column(db.Boolean(), default=False, nullable=False)
+	destination_id = db.Column(db.Integer, db.ForeignKey('destination.id'))
+	destination = db.relationship('Destination', backref=db.backref('items', lazy=True))
+	__table_args__ = (db.Index('ix_item_destination', 'destination_id'),)
+
+
+class Trip(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	date = db.Column(db.Date(), nullable=False)
+	closed = db.Column(db.Boolean(), default=False, nullable=False)
+	destination_id = db.Column(db.Integer, db.ForeignKey('destination.id'))
+	destination = db.relationship('Destination')
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	user = db.relationship('User', backref=db.backref('trips', lazy=True))
+	# Bumped by touch_trip whenever something shown on the trip's pages changes
+	version = db.Column(db.Integer, default=1, nullable=False)
+	modified = db.Column(db.DateTime(), default=datetime.datetime.utcnow, nullable=True)
+	__table_args__ = (
+		db.UniqueConstraint('user_id', 'date', 'destination_id'),
+		db.Index('ix_trip_date', 'date'),
+	)
+
+	def get_items_grouped(self, catalog, with_users=False):
+		return items_grouped(Order, self.id, catalog, with_users)
+
+
+# One line of a user's order on a trip, covering `count` units of an item.
+# A user can have several lines for the same item that differ in `settled`, so partial settlement is tracked per line.
+class Order(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	count = db.Column(db.Integer, default=1, nullable=False)
+	settled = db.Column(db.Boolean(), default=False, nullable=False)
+	item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
+	item = db.relationship('Item')
+	trip_id = db.Column(db.Integer, db.ForeignKey('trip.id'))
+	trip = db.relationship('Trip', backref=db.backref('orders', lazy=True))
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	user = db.relationship('User', backref=db.backref('orders', lazy=True))
+	__table_args__ = (
+		# trip_submit_order and the counts on date_show, also covers lookups by trip alone
+		db.Index('ix_order_trip_user_item', 'trip_id', 'user_id', 'item_id'),
+		# outgoing orders on settle_show
+		db.Index('ix_order_user_settled', 'user_id', 'settled'),
+		# outstanding orders of an item in the CLI
+		db.Index('ix_order_item', 'item_id'),
+	)
+
+
+# Trips that `noodlz archive` moved out of the trip table because they are closed and fully settled (see archive.py).
+# They keep their ids, and each row also keeps the totals of its orders, so the date page doesn't have to add them up again.
+class ArchivedTrip(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	date = db.Column(db.Date(), nullable=False)
+	closed = db.Column(db.Boolean(), default=True, nullable=False)
+	destination_id = db.Column(db.Integer, db.ForeignKey('destination.id'))
+	destination = db.relationship('Destination')
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	user = db.relationship('User')
+	version = db.Column(db.Integer, default=1, nullable=False)
+	modified = db.Column(db.DateTime(), nullable=True)
+	users = db.Column(db.Integer, default=0, nullable=False)
+	units = db.Column(db.Integer, default=0, nullable=False)
+	total = db.Column(db.Numeric(9, scale=2), default=0, nullable=False)
+	__table_args__ = (db.Index('ix_archived_trip_date', 'date'),)
+
+	def get_items_grouped(self, catalog, with_users=False):
+		return items_grouped(ArchivedOrder, self.id, catalog, with_users)
+
+
+# Order lines of archived trips, all of them settled
+class ArchivedOrder(db.Model):
+	# Lets templates that list both kinds of orders tell them apart
+	archived = True
+	id = db.Column(db.Integer, primary_key=True)
+	count = db.Column(db.Integer, default=1, nullable=False)
+	settled = db.Column(db.Boolean(), default=True, nullable=False)
+	item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
+	item = db.relationship('Item')
+	trip_id = db.Column(db.Integer, db.ForeignKey('archived_trip.id'))
+	trip = db.relationship('ArchivedTrip')
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	user = db.relationship('User')
+	__table_args__ = (
+		db.Index('ix_archived_order_trip_user_item', 'trip_id', 'user_id', 'item_id'),
+		db.Index('ix_archived_order_item', 'item_id'),
+		# outgoing orders in the history on settle_show
+		db.Index('ix_archived_order_user', 'user_id'),
+	)
+
+
+def items_grouped(order_model, trip_id, catalog, with_users=False):
+	'''Returns the items (from `catalog`) ordered on a trip with their total count (and optionally who ordered how many), aggregated in SQL.
+	`order_model` is Order or ArchivedOrder, depending on where the trip is.'''
+	rows = db.session.query(order_model.item_id, db.func.sum(order_model.count)) \
+		.filter(order_model.trip_id == trip_id) \
+		.group_by(order_model.item_id) \
+		.order_by(order_model.item_id) \
+		.all()
+	item_users = {}
+	if with_users:
+		query = db.session.query(order_model.item_id, User, db.func.sum(order_model.count)) \
+			.join(User, order_model.user_id == User.id) \
+			.filter(order_model.trip_id == trip_id) \
+			.group_by(order_model.item_id, User.id) \
+			.order_by(User.name)
+		for item_id, user, count in query:
+			item_users.setdefault(item_id, []).append({"user": user, "count": count})
+	return [{"item": catalog.items[item_id], "count": count, "users": item_users.get(item_id, [])} for item_id, count in rows]
+
+
+# Unsettled debt of one user towards another, kept up to date by every change to orders (see adjust_balances)
+class Balance(db.Model):
+	debtor_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	creditor_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	amount = db.Column(db.Numeric(9, scale=2), default=0, nullable=False)
+	__table_args__ = (db.Index('ix_balance_creditor', 'creditor_id'),)
+
+
+# Counters that are bumped whenever something that workers cache changes, e.g. by the CLI
+class Version(db.Model):
+	name = db.Column(db.String(32), primary_key=True)
+	value = db.Column(db.Integer, default=0, nullable=False)
+
+
+# Failed logins within the current window, counted by passwords.py
+class LoginFailure(db.Model):
+	# 'user:<name>' or 'addr:<remote address>'
+	key = db.Column(db.String(80), primary_key=True)
+	count = db.Column(db.Integer, default=0, nullable=False)
+	since = db.Column(db.DateTime(), nullable=False)
+
+
+# Changes that the date page shows live, streamed to browsers by events.py
+class Event(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	date = db.Column(db.Date(), nullable=False)
+	kind = db.Column(db.String(16), nullable=False)
+	data = db.Column(db.Text(), nullable=False)
+	created = db.Column(db.DateTime(), default=datetime.datetime.utcnow, nullable=False)
+	__table_args__ = (
+		db.Index('ix_event_date', 'date', 'id'),
+		db.Index('ix_event_created', 'created'),
+	)
+
+
+def get_version(name):
+	return db.session.query(Version.value).filter_by(name=name).scalar() or 0
+
+
+def bump_version(name):
+	if Version.query.filter_by(name=name).update({'value': Version.value + 1}, synchronize_session=False) == 0:
+		db.session.add(Version(name=name, value=1))
+
+
+def touch_trip(trip_id):
+	Trip.query.filter_by(id=trip_id).update({'version': Trip.version + 1, 'modified': datetime.datetime.utcnow()}, synchronize_session=False)
+
+
+def publish_event(date, kind, **data):
+	'''Record an event for the streams of `date`, in the current transaction, and forget events older than EVENT_RETENTION seconds.'''
+	db.session.add(Event(date=date, kind=kind, data=json.dumps(data)))
+	cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=float(current_app.config.get('EVENT_RETENTION', 24 * 60 * 60)))
+	Event.query.filter(Event.created < cutoff).delete(synchronize_session=False)
+
+
+def trip_totals(trip_ids):
+	'''{trip id: (number of users, number of units)} of everything ordered on the trips'''
+	query = db.session.query(Order.trip_id, db.func.count(db.distinct(Order.user_id)), db.func.sum(Order.count)) \
+		.filter(Order.trip_id.in_(trip_ids), Order.count > 0) \
+		.group_by(Order.trip_id)
+	return {trip_id: (users, units) for trip_id, users, units in query}
+
+
+def trips_on(date):
+	'''Returns the trips of `date` and whether they are archived.
+	`noodlz archive` only moves whole dates, so the trips of a date are either all in the trip table or all in archived_trip.'''
+	trips = Trip.query.filter_by(date=date) \
+		.options(joinedload(Trip.user)) \
+		.order_by(Trip.id) \
+		.all()
+	if trips:
+		return trips, False
+	trips = ArchivedTrip.query.filter_by(date=date) \
+		.options(joinedload(ArchivedTrip.user)) \
+		.order_by(ArchivedTrip.id) \
+		.all()
+	return trips, bool(trips)
+
+
+def find_trip(trip_id):
+	'''The trip or archived trip with that id, or None'''
+	trip = Trip.query.filter_by(id=trip_id).first()
+	if trip is None:
+		trip = ArchivedTrip.query.filter_by(id=trip_id).first()
+	return trip
+
+
+def order_debt(count, price, settled, user_id, buyer_id):
+	'''How much the user of an order line owes the buyer of the trip for it.'''
+	if settled or price <= 0 or user_id == buyer_id:
+		return 0
+	return count * price
+
+
+def adjust_balances(deltas):
+	'''Apply {(debtor_id, creditor_id): amount} changes to the balance ledger, in the current transaction.'''
+	for (debtor_id, creditor_id), amount in deltas.items():
+		if amount == 0:
+			continue
+		updated = Balance.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id).update({'amount': Balance.amount + amount}, synchronize_session=False)
+		if updated == 0:
+			db.session.add(Balance(debtor_id=debtor_id, creditor_id=creditor_id, amount=amount))
+
+
+def compute_balances():
+	'''Compute the balance ledger from scratch from all unsettled orders.'''
+	query = db.session.query(Order.user_id, Trip.user_id, db.func.sum(Order.count * Item.price)) \
+		.join(Order.trip) \
+		.join(Order.item) \
+		.filter(Order.settled == False, Order.user_id != Trip.user_id, Item.price > 0) \
+		.group_by(Order.user_id, Trip.user_id)
+	return {(debtor_id, creditor_id): amount for debtor_id, creditor_id, amount in query}
+
+
+def rebuild_balances():
+	Balance.query.delete(synchronize_session=False)
+	db.session.bulk_insert_mappings(Balance, [{'debtor_id': debtor_id, 'creditor_id': creditor_id, 'amount': amount} for (debtor_id, creditor_id), amount in compute_balances().items()])
+
+
+def settle_orders(buyer_id, user_id=None, until=None, trip_id=None, settled=True):
+	'''Mark the orders on the trips of `buyer_id` as settled (or unsettled) with a single UPDATE, and adjust the ledger to match.
+	Optionally only the orders of one user, of trips up to a date, or of one trip. Returns the number of changed order lines.'''
+	trip_criteria = [Trip.user_id == buyer_id]
+	if until is not None:
+		trip_criteria.append(Trip.date <= until)
+	if trip_id is not None:
+		trip_criteria.append(Trip.id == trip_id)
+	query = Order.query.filter(Order.trip.has(db.and_(*trip_criteria)), Order.settled != settled)
+	if user_id is not None:
+		query = query.filter(Order.user_id == user_id)
+
+	debts = query.join(Order.item) \
+		.filter(Item.price > 0, Order.user_id != buyer_id) \
+		.with_entities(Order.user_id, db.func.sum(Order.count * Item.price)) \
+		.group_by(Order.user_id)
+	deltas = {(debtor_id, buyer_id): -amount if settled else amount for debtor_id, amount in debts}
+	changed = query.update({'settled': settled}, synchronize_session=False)
+	adjust_balances(deltas)
+	return changed
+
+
+def parse_date(date_str):
+	return datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
+
+
+def parse_bool(b):
+	if b in (True, 1, 'true', 'yes', 'on', '1'):
+		return True
+	elif b in (False, 0, 'false', 'no', 'off', '0'):
+		return False
+	raise ValueError("Not a valid boolean")
+
+
+def now():
+	return datetime.datetime.now().date()
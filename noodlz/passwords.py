@@ -0,0 +1,136 @@
+'''Password hashes and login checks.
+bcrypt is slow on purpose, so hashes are checked on a few threads per worker (bcrypt releases the GIL), and only a bounded number of logins may wait for them.
+A login storm then gets 503s instead of tying up the request threads that everything else needs.
+Failed logins are counted per user name and per address in the login_failure table, which all workers share, and refused with 429 over a limit.'''
+import concurrent.futures
+import datetime
+import threading
+
+from flask import current_app, request
+from passlib.context import CryptContext
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from .models import db, retry_on_lock, User, LoginFailure
+
+# Created on first use, so that BCRYPT_ROUNDS is read from the configuration and every (forked) worker gets its own threads
+_context = None
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+def _make_context(rounds):
+	return CryptContext(schemes=['bcrypt'], bcrypt__rounds=rounds)
+
+
+def get_context():
+	'''Hashes with fewer rounds than BCRYPT_ROUNDS are replaced on the next successful login'''
+	global _context
+	if _context is None:
+		_context = _make_context(int(current_app.config.get('BCRYPT_ROUNDS', 12)))
+	return _context
+
+
+def hash_password(password, rounds=None):
+	'''Hashes with BCRYPT_ROUNDS, or with `rounds` where there's no app context (e.g. in a process pool)'''
+	context = get_context() if rounds is None else _make_context(rounds)
+	return context.hash(password)
+
+
+def _pool():
+	global _executor, _slots
+	with _lock:
+		if _executor is None:
+			threads = int(current_app.config.get('LOGIN_THREADS', 2))
+			_executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='noodlz-login')
+			_slots = threading.BoundedSemaphore(threads + int(current_app.config.get('LOGIN_QUEUE', 8)))
+	return _executor, _slots
+
+
+def _verify(context, password, pass_hash):
+	if pass_hash is None:
+		# Takes as long as a real check, so unknown names can't be told apart by timing
+		context.dummy_verify()
+		return False, None
+	return context.verify_and_update(password, pass_hash)
+
+
+def verify(password, pass_hash):
+	'''Returns whether `password` matches `pass_hash` (None for unknown users), and a new hash to store or None.
+	Aborts with 503 if LOGIN_THREADS + LOGIN_QUEUE checks are already running or waiting in this worker.'''
+	executor, slots = _pool()
+	if not slots.acquire(blocking=False):
+		raise ServiceUnavailable("Too many people are logging in right now, try again in a moment.", retry_after=1)
+	try:
+		future = executor.submit(_verify, get_context(), password, pass_hash)
+	except BaseException:
+		slots.release()
+		raise
+	future.add_done_callback(lambda future: slots.release())
+	return future.result()
+
+
+def _limits(name):
+	return {
+		f'user:{name}': int(current_app.config.get('LOGIN_MAX_FAILURES', 5)),
+		f'addr:{request.remote_addr}': int(current_app.config.get('LOGIN_MAX_FAILURES_PER_ADDRESS', 20)),
+	}
+
+
+def _window():
+	return datetime.timedelta(seconds=float(current_app.config.get('LOGIN_FAILURE_WINDOW', 300)))
+
+
+def check_throttle(name):
+	'''Aborts with 429 if the name or the address had too many failed logins within the last LOGIN_FAILURE_WINDOW seconds.
+	Returns whether the name had any.'''
+	now = datetime.datetime.utcnow()
+	limits = _limits(name)
+	failed = False
+	for failure in LoginFailure.query.filter(LoginFailure.key.in_(limits), LoginFailure.since >= now - _window()):
+		if failure.count >= limits[failure.key]:
+			raise TooManyRequests("Too many failed logins, try again later.", retry_after=int((failure.since + _window() - now).total_seconds()) + 1)
+		failed = failed or failure.key.startswith('user:')
+	return failed
+
+
+@retry_on_lock
+def record_failure(name):
+	now = datetime.datetime.utcnow()
+	cutoff = now - _window()
+	for key in _limits(name):
+		failure = db.session.get(LoginFailure, key)
+		if failure is None:
+			db.session.add(LoginFailure(key=key, count=1, since=now))
+		elif failure.since < cutoff:
+			failure.count = 1
+			failure.since = now
+		else:
+			failure.count += 1
+	LoginFailure.query.filter(LoginFailure.since < cutoff).delete(synchronize_session=False)
+	db.session.commit()
+
+
+@retry_on_lock
+def record_success(user_id, name, new_hash, failed):
+	if new_hash is not None:
+		User.query.filter_by(id=user_id).update({'pass_hash': new_hash}, synchronize_session=False)
+	if failed:
+		LoginFailure.query.filter_by(key=f'user:{name}').delete(synchronize_session=False)
+	db.session.commit()
+
+
+def authenticate(name, password):
+	'''Returns the id of the user if `password` is theirs, None otherwise.
+	Aborts with 429 while the name or address is throttled, and with 503 while too many logins are being checked.'''
+	failed = check_throttle(name)
+	row = db.session.query(User.id, User.pass_hash).filter_by(name=name).first()
+	# Don't keep the connection while hashing
+	db.session.rollback()
+	valid, new_hash = verify(password, row.pass_hash if row is not None else None)
+	if not valid:
+		record_failure(name)
+		return None
+	if new_hash is not None or failed:
+		record_success(row.id, name, new_hash, failed)
+	return row.id
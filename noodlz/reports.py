@@ -0,0 +1,185 @@
+'''Statistics over all orders, aggregated in SQL per month.
+Months that are over and have no open trips anymore rarely change, so their results are stored in the report_cache table.
+Trips can still be added to past dates, and touch_trip bumps the version of a trip whenever its orders change, so a cached month is only used while the number, highest id and summed versions of its trips are the same.'''
+import datetime
+import decimal
+import json
+
+import sqlalchemy.exc
+from flask import current_app
+from sqlalchemy.orm import aliased
+
+from .models import db, now, get_version, is_locked, retry_on_lock
+from .models import User, Destination, Item, Trip, Order, ArchivedTrip, ArchivedOrder, Balance
+
+
+class ReportCache(db.Model):
+	report = db.Column(db.String(32), primary_key=True)
+	month = db.Column(db.Date(), primary_key=True)
+	catalog_version = db.Column(db.Integer, nullable=False)
+	# Number, highest id and summed versions of the month's trips when the rows were stored
+	trips = db.Column(db.String(64), nullable=False, default='')
+	rows = db.Column(db.Text(), nullable=False)
+
+
+# name -> (column names, number of leading key columns, function(start, end, trip model, order model) returning a query of rows)
+# The rows of a month with both archived and current trips are added up by their key columns.
+REPORTS = {}
+
+
+def report(name, columns, keys=1):
+	def decorator(f):
+		REPORTS[name] = (columns, keys, f)
+		return f
+	return decorator
+
+
+def _spent(orders):
+	return db.func.sum(orders.count * Item.price)
+
+
+@report('destinations', ['destination', 'trips', 'units', 'spent'])
+def destinations_report(start, end, trips, orders):
+	return db.session.query(Destination.name, db.func.count(db.distinct(trips.id)), db.func.sum(orders.count), _spent(orders)) \
+		.select_from(orders) \
+		.join(trips, orders.trip_id == trips.id) \
+		.join(Destination, trips.destination_id == Destination.id) \
+		.join(Item, orders.item_id == Item.id) \
+		.filter(trips.date >= start, trips.date < end) \
+		.group_by(Destination.id) \
+		.order_by(_spent(orders).desc())
+
+
+@report('items', ['item', 'destination', 'units', 'spent'], keys=2)
+def items_report(start, end, trips, orders):
+	return db.session.query(Item.name, Destination.name, db.func.sum(orders.count), _spent(orders)) \
+		.select_from(orders) \
+		.join(trips, orders.trip_id == trips.id) \
+		.join(Item, orders.item_id == Item.id) \
+		.join(Item.destination) \
+		.filter(trips.date >= start, trips.date < end) \
+		.group_by(Item.id, Destination.id) \
+		.order_by(db.func.sum(orders.count).desc())
+
+
+@report('users', ['user', 'trips', 'units', 'spent'])
+def users_report(start, end, trips, orders):
+	return db.session.query(User.name, db.func.count(db.distinct(trips.id)), db.func.sum(orders.count), _spent(orders)) \
+		.select_from(orders) \
+		.join(trips, orders.trip_id == trips.id) \
+		.join(Item, orders.item_id == Item.id) \
+		.join(User, orders.user_id == User.id) \
+		.filter(trips.date >= start, trips.date < end) \
+		.group_by(User.id) \
+		.order_by(_spent(orders).desc())
+
+
+def _merge(rows, more_rows, keys):
+	'''Adds up rows with the same key columns. Keeps the order of `rows`, which is only approximately right for the ones from `more_rows`.'''
+	merged = {tuple(row[:keys]): list(row) for row in rows}
+	for row in more_rows:
+		entry = merged.get(tuple(row[:keys]))
+		if entry is None:
+			merged[tuple(row[:keys])] = list(row)
+			continue
+		for i in range(keys, len(row)):
+			if row[i] is not None:
+				entry[i] = row[i] if entry[i] is None else entry[i] + row[i]
+	return list(merged.values())
+
+
+DEBT_COLUMNS = ['debtor', 'creditor', 'amount']
+
+
+def debt_report():
+	'''Outstanding debt between users, straight from the balance ledger.'''
+	debtor = aliased(User)
+	creditor = aliased(User)
+	return db.session.query(debtor.name, creditor.name, Balance.amount) \
+		.join(debtor, Balance.debtor_id == debtor.id) \
+		.join(creditor, Balance.creditor_id == creditor.id) \
+		.filter(Balance.amount != 0) \
+		.order_by(Balance.amount.desc()) \
+		.all()
+
+
+def parse_month(month_str):
+	return datetime.datetime.strptime(month_str, '%Y-%m').date()
+
+
+def next_month(month):
+	return (month.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _to_json(value):
+	if isinstance(value, decimal.Decimal):
+		return str(value)
+	return value
+
+
+@retry_on_lock
+def _store(entries):
+	for entry in entries:
+		db.session.merge(entry)
+	db.session.commit()
+
+
+def monthly_report(name, since=None, until=None):
+	'''Returns [(month, rows)] for every month between `since` and `until` (first days of months, inclusive) that has trips.'''
+	columns, keys, query_function = REPORTS[name]
+	# month -> whether all trips are closed, [number of trips, highest id, sum of versions], and the models the trips of the month are in
+	months = {}
+	fingerprints = {}
+	sources = {}
+	queries = []
+	for archived, trips in enumerate((Trip, ArchivedTrip)):
+		query = db.select(trips.date, db.func.min(trips.closed), db.func.count(trips.id), db.func.max(trips.id), db.func.sum(trips.version), db.literal(archived)) \
+			.group_by(trips.date)
+		if since is not None:
+			query = query.where(trips.date >= since)
+		if until is not None:
+			query = query.where(trips.date < next_month(until))
+		queries.append(query)
+	for date, closed, count, max_id, versions, archived in db.session.execute(db.union_all(*queries)):
+		month = date.replace(day=1)
+		months[month] = months.get(month, True) and bool(closed)
+		fingerprint = fingerprints.setdefault(month, [0, 0, 0])
+		fingerprint[0] += count
+		fingerprint[1] = max(fingerprint[1], max_id)
+		fingerprint[2] += versions
+		models = (ArchivedTrip, ArchivedOrder) if archived else (Trip, Order)
+		if models not in sources.setdefault(month, []):
+			sources[month].append(models)
+	current_month = now().replace(day=1)
+	catalog_version = get_version('catalog')
+
+	fingerprints = {month: ':'.join(map(str, fingerprint)) for month, fingerprint in fingerprints.items()}
+
+	cached = {}
+	if months:
+		for entry in ReportCache.query.filter(ReportCache.report == name, ReportCache.month.in_(months), ReportCache.catalog_version == catalog_version):
+			if entry.trips == fingerprints[entry.month]:
+				cached[entry.month] = json.loads(entry.rows)
+
+	result = []
+	entries = []
+	for month in sorted(months):
+		rows = cached.get(month)
+		if rows is None:
+			rows = None
+			for trips, orders in sources[month]:
+				more_rows = query_function(month, next_month(month), trips, orders).all()
+				rows = more_rows if rows is None else _merge(rows, more_rows, keys)
+			rows = [[_to_json(value) for value in row] for row in rows]
+			if month < current_month and months[month]:
+				entries.append(ReportCache(report=name, month=month, catalog_version=catalog_version, trips=fingerprints[month], rows=json.dumps(rows)))
+		result.append((month, rows))
+	if entries:
+		try:
+			_store(entries)
+		except sqlalchemy.exc.OperationalError as e:
+			# The reports are correct without the cache, a read shouldn't fail because of it
+			if not is_locked(e):
+				raise
+			current_app.logger.warning("Database is locked, %d months of the %s report weren't cached", len(entries), name)
+	return result
@@ -0,0 +1,16 @@
+'''Routes are collected here when their modules are imported, and create_app adds them to the app.
+That way modules don't need an app to be imported, and endpoints keep their plain names, which a blueprint would prefix.'''
+# (rule, view function, options of add_url_rule)
+ROUTES = []
+
+
+def route(rule, **options):
+	def decorator(f):
+		ROUTES.append((rule, f, options))
+		return f
+	return decorator
+
+
+def register(app):
+	for rule, f, options in ROUTES:
+		app.add_url_rule(rule, view_func=f, **options)
@@ -0,0 +1,77 @@
+'''Settles the whole group at once, with as few cash hand-overs as possible instead of one per pair of users in the ledger.
+Only what every user owes or is owed in total matters, which the balance ledger sums up in a single query.
+Debtors and creditors that are off by the same amount pay each other directly; after that the largest debtor pays the largest creditor, until one of them is even.
+That needs at most one transfer less than there are users with a balance, usually close to the minimum (which is too expensive to find for a big group), in O(n log n).
+Once all transfers of a plan have been made everyone is even. Applying the plan then settles every buyer's trips the way the settle page does, with settle_orders, so the ledger stays in step.
+That settles orders on other people's trips, so only the CLI applies plans; the page only shows them.'''
+import decimal
+import hashlib
+import heapq
+
+from .models import db, Balance, Order, settle_orders
+
+CENT = decimal.Decimal('0.01')
+
+
+def net_balances():
+	'''{user_id: amount} that each user is owed in total, negative if they owe, for all users that aren't even'''
+	credits = db.select(Balance.creditor_id.label('user_id'), Balance.amount.label('amount'))
+	debts = db.select(Balance.debtor_id.label('user_id'), (-Balance.amount).label('amount'))
+	both = db.union_all(credits, debts).subquery()
+	query = db.session.query(both.c.user_id, db.func.sum(both.c.amount)).group_by(both.c.user_id)
+	net = {user_id: decimal.Decimal(amount).quantize(CENT) for user_id, amount in query}
+	return {user_id: amount for user_id, amount in net.items() if amount != 0}
+
+
+def transfers(net):
+	'''[(debtor_id, creditor_id, amount)] that make everyone in `net` even.'''
+	result = []
+	debtors = {}
+	creditors = {}
+	for user_id, amount in sorted(net.items()):
+		if amount < 0:
+			debtors.setdefault(-amount, []).append(user_id)
+		elif amount > 0:
+			creditors.setdefault(amount, []).append(user_id)
+	for amount in sorted(set(debtors) & set(creditors)):
+		while debtors[amount] and creditors[amount]:
+			result.append((debtors[amount].pop(), creditors[amount].pop(), amount))
+
+	# Max-heaps of (-amount, user_id)
+	debtors = [(-amount, user_id) for amount, user_ids in debtors.items() for user_id in user_ids]
+	creditors = [(-amount, user_id) for amount, user_ids in creditors.items() for user_id in user_ids]
+	heapq.heapify(debtors)
+	heapq.heapify(creditors)
+	while debtors and creditors:
+		debt, debtor_id = heapq.heappop(debtors)
+		credit, creditor_id = heapq.heappop(creditors)
+		amount = min(-debt, -credit)
+		result.append((debtor_id, creditor_id, amount))
+		if -debt > amount:
+			heapq.heappush(debtors, (debt + amount, debtor_id))
+		if -credit > amount:
+			heapq.heappush(creditors, (credit + amount, creditor_id))
+	return sorted(result, key=lambda transfer: (-transfer[2], transfer[0], transfer[1]))
+
+
+def plan_token():
+	'''Changes whenever the ledger or the orders change, so a plan is only applied to the balances it was made for'''
+	digest = hashlib.sha256()
+	for row in db.session.query(Balance.debtor_id, Balance.creditor_id, Balance.amount).filter(Balance.amount != 0).order_by(Balance.debtor_id, Balance.creditor_id):
+		digest.update(repr(row).encode())
+	digest.update(repr(db.session.query(db.func.max(Order.id)).scalar()).encode())
+	return digest.hexdigest()[:32]
+
+
+def plan():
+	'''Returns the transfers that settle the whole group and the token to apply them with'''
+	return transfers(net_balances()), plan_token()
+
+
+def apply_plan(token=None):
+	'''Settles the unsettled orders behind every balance in the ledger, in the current transaction.
+	Returns the number of changed order lines, or None if the balances changed since the plan of `token` was made.'''
+	if token is not None and plan_token() != token:
+		return None
+	creditors = [creditor_id for creditor_id, in db.session.query(Balance.creditor_id).filter(Balance.amount != 0).distinct().order_by(Balance.creditor_id)]
+	return sum(settle_orders(creditor_id) for creditor_id in creditors)
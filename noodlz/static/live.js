@@ -0,0 +1,66 @@
+// Applies the events of /<date>/events to the date page, see events.py
+(function () {
+	"use strict";
+	if (!window.EventSource) {
+		return;
+	}
+	var url = new URL(document.body.dataset.events, window.location.href);
+	var notice = document.querySelector("section.msg.live");
+	// Seconds until the next try after the server refused the stream, see EVENT_MAX_STREAMS
+	var delay = 10;
+
+	function section(trip) {
+		return document.querySelector('section.trip[data-trip="' + trip + '"]');
+	}
+
+	function announce(text) {
+		notice.querySelector("span").textContent = text;
+		notice.hidden = false;
+	}
+
+	var listeners = {};
+	listeners["trip-added"] = function (e) {
+		var data = JSON.parse(e.data);
+		if (!section(data.trip)) {
+			announce(data.buyer + " is going to " + data.destination + ".");
+		}
+	};
+	listeners["trip-closed"] = function (e) {
+		var trip = section(JSON.parse(e.data).trip);
+		if (trip && !trip.classList.contains("closed")) {
+			trip.classList.add("closed");
+			trip.querySelectorAll("input, button[formaction$='/order'], button[formaction$='/close']").forEach(function (element) {
+				element.disabled = true;
+			});
+			announce("A trip was closed.");
+		}
+	};
+	listeners.counts = function (e) {
+		var data = JSON.parse(e.data);
+		var trip = section(data.trip);
+		if (trip) {
+			trip.querySelector(".totals").textContent = data.users + " people, " + data.units + " items";
+		}
+	};
+
+	function connect() {
+		var source = new EventSource(url.href);
+		Object.keys(listeners).forEach(function (kind) {
+			source.addEventListener(kind, function (e) {
+				url.searchParams.set("after", e.lastEventId);
+				listeners[kind](e);
+			});
+		});
+		source.addEventListener("open", function () {
+			delay = 10;
+		});
+		// The browser reconnects by itself after a stream ends, but not after an error status like the 503 for too many streams
+		source.addEventListener("error", function () {
+			if (source.readyState === EventSource.CLOSED) {
+				window.setTimeout(connect, delay * 1000);
+				delay = Math.min(delay * 2, 300);
+			}
+		});
+	}
+	connect();
+})();
@@ -0,0 +1,66 @@
+'''Generates a large, random but plausible history of trips and orders, to make slow pages show up in development and benchmarks.'''
+import datetime
+import random
+
+from .models import db, User, Destination, Item, Trip, Order, rebuild_balances, now
+from .passwords import hash_password
+
+
+def user_name(n):
+	return f"user{n:04d}"
+
+
+def create_synthetic_data(users=50, weeks=52, destinations=5, items_per_destination=20, seed=0, password="password"):
+	'''Adds `users` users (all with the same password) and `weeks` Mondays of trips to `destinations` destinations, ending with the current week.
+	Rows are inserted in bulk with explicit ids, so the database should be empty.'''
+	rng = random.Random(seed)
+	# Hashing is slow on purpose, every user gets the same hash
+	pass_hash = hash_password(password)
+	db.session.bulk_insert_mappings(User, [{'id': u, 'name': user_name(u), 'pass_hash': pass_hash} for u in range(1, users + 1)])
+	db.session.bulk_insert_mappings(Destination, [{'id': d, 'name': f"Destination {d}"} for d in range(1, destinations + 1)])
+
+	items = []
+	menus = {}
+	for d in range(1, destinations + 1):
+		for k in range(items_per_destination):
+			item_id = len(items) + 1
+			options = ";".join(f"Option {o}" for o in rng.sample(range(1, 10), rng.randint(0, 3)))
+			items.append({
+				'id': item_id,
+				'name': f"Item {d}.{k}" + (";" + options if options else ""),
+				'tag': str(k) if rng.random() < 0.8 else None,
+				'price': round(rng.uniform(0, 12), 2) if rng.random() < 0.95 else 0,
+				'historical': rng.random() < 0.05,
+				'destination_id': d,
+			})
+			menus.setdefault(d, []).append(items[-1])
+	db.session.bulk_insert_mappings(Item, items)
+
+	today = now()
+	last_monday = today - datetime.timedelta(days=today.weekday())
+	trips = []
+	orders = []
+	for week in range(weeks):
+		date = last_monday - datetime.timedelta(weeks=weeks - week - 1)
+		current = week == weeks - 1
+		for d in rng.sample(range(1, destinations + 1), rng.randint(1, destinations)):
+			buyer = rng.randint(1, users)
+			trip_id = len(trips) + 1
+			trips.append({'id': trip_id, 'date': date, 'closed': not current or rng.random() < 0.3, 'destination_id': d, 'user_id': buyer})
+			orderable = [item for item in menus[d] if not item['historical']] or menus[d]
+			for user in rng.sample(range(1, users + 1), max(1, int(users * rng.uniform(0.05, 0.4)))):
+				for item in rng.sample(orderable, min(len(orderable), rng.randint(1, 3))):
+					orders.append({
+						'id': len(orders) + 1,
+						'count': rng.choice((1, 1, 1, 2, 3)),
+						'settled': item['price'] <= 0 or user == buyer or rng.random() < (0.3 if current else 0.9),
+						'item_id': item['id'],
+						'trip_id': trip_id,
+						'user_id': user,
+					})
+	db.session.bulk_insert_mappings(Trip, trips)
+	db.session.bulk_insert_mappings(Order, orders)
+	db.session.flush()
+	rebuild_balances()
+	db.session.commit()
+	return {'users': users, 'destinations': destinations, 'items': len(items), 'trips': len(trips), 'orders': len(orders)}
@@ -0,0 +1,541 @@
+'''The HTML pages.'''
+import collections
+import datetime
+import functools
+import hashlib
+
+from flask import current_app, url_for, redirect, render_template, abort, make_response
+from flask import session, request, g, jsonify
+from markupsafe import Markup
+import sqlalchemy.exc
+from sqlalchemy.orm import contains_eager, joinedload
+from werkzeug.http import is_resource_modified
+
+from . import __version__, passwords, reports, settlement
+from .cache import Cache
+from .catalog import build_catalog
+from .models import db, retry_on_lock, User, Destination, Item, Trip, Order, ArchivedOrder, ArchivedTrip, Balance, Event
+from .models import get_version, touch_trip, publish_event, trip_totals, trips_on, find_trip, order_debt, adjust_balances, settle_orders
+from .models import parse_date, parse_bool, now
+from .routing import route
+
+GLOBAL_PARAMS = {'version': __version__}
+
+
+@route("/")
+def index():
+	return redirect(url_for("date_show", date=now().isoformat()))
+
+
+@route("/favicon.ico")
+def favicon():
+	return current_app.send_static_file('favicon.ico')
+
+
+def fullpath(request):
+	fp = request.path
+	if request.query_string:
+		fp += '?' + str(request.query_string, 'utf-8')
+	return fp
+
+
+# What the views need to know about the logged in user, cached per worker
+CachedUser = collections.namedtuple('CachedUser', ['id', 'name'])
+# Sized by init_app from the configuration
+user_cache = Cache()
+
+
+def get_cached_user(user_id):
+	user_cache.check_version(lambda: get_version('user'))
+	cached = user_cache.get(user_id)
+	if cached is None:
+		user = User.query.filter_by(id=user_id).first()
+		if user is not None:
+			cached = user_cache.put(user_id, CachedUser(user.id, user.name))
+	return cached
+
+
+def require_user(f):
+	@functools.wraps(f)
+	def wrapper(*args, **kwargs):
+		if 'user_id' not in session:
+			return render_template('login.html', version=__version__, redirect=fullpath(request))
+		else:
+			g.user = get_cached_user(session['user_id'])
+			if g.user is None:
+				abort(500, "Your account doesn't exist anymore.")
+			return f(*args, **kwargs)
+	return wrapper
+
+
+@route("/login", methods=['POST'])
+def login():
+	if not current_app.config['RE_USER'].match(request.form["user"]):
+		abort(400, "Invalid username.")
+	user_id = passwords.authenticate(request.form["user"], request.form.get("pass", ""))
+	if user_id is None:
+		abort(403, "Invalid username or password")
+	session['user_id'] = user_id
+	return redirect(request.args.get('redirect', url_for('date_show', date=now().isoformat())))
+
+
+@route("/logout", methods=['GET', 'POST'])
+def logout():
+	if 'user_id' in session:
+		del session['user_id']
+	return redirect(request.args.get('redirect', url_for('date_show', date=now().isoformat())))
+
+
+def make_etag(*parts):
+	return hashlib.sha1(repr((__version__,) + parts).encode('utf-8')).hexdigest()
+
+
+def conditional(response, etag, last_modified=None):
+	response.set_etag(etag)
+	if last_modified is not None:
+		response.last_modified = last_modified
+	# Pages depend on the logged in user, so only the browser may keep them, and it has to ask every time
+	response.cache_control.private = True
+	response.cache_control.no_cache = True
+	return response
+
+
+def not_modified(etag, last_modified=None):
+	if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+		return None
+	return conditional(make_response('', 304), etag, last_modified)
+
+
+_catalog = None
+
+
+def get_catalog():
+	'''This worker's catalog snapshot (see catalog.py), rebuilt when the 'catalog' version changed. Otherwise it only costs the version lookup.'''
+	global _catalog
+	version = get_version('catalog')
+	catalog = _catalog
+	if catalog is None or catalog.version != version:
+		catalog = _catalog = build_catalog(version, Destination.query.all(), Item.query.all())
+	return catalog
+
+
+fragment_cache = Cache()
+
+
+@route("/status", methods=['GET'])
+def status():
+	return jsonify(version=__version__, caches={'user': user_cache.stats(), 'fragment': fragment_cache.stats()})
+
+
+@route("/terms", methods=['GET'])
+def terms():
+	return render_template('terms.html', version=__version__)
+
+
+@route("/<date>/", methods=["GET"])
+@require_user
+def date_show(date):
+	date = parse_date(date)
+	if date.weekday() != 0:
+		return render_template("notmonday.html", version=__version__)
+	trips, archived = trips_on(date)
+	catalog = get_catalog()
+	catalog_version = catalog.version
+	# Live updates continue after the last event the page knows about
+	last_event = db.session.query(db.func.max(Event.id)).filter(Event.date == date).scalar() or 0
+	etag = make_etag('date', date, g.user, catalog_version, last_event, [(trip.id, trip.version) for trip in trips])
+	last_modified = max((trip.modified for trip in trips if trip.modified is not None), default=None)
+	response = not_modified(etag, last_modified)
+	if response is not None:
+		return response
+
+	# Sections of closed trips in the past don't change anymore, so they are only rendered once per trip version
+	sections = {}
+	def fragment_key(trip):
+		if trip.closed and trip.date < now():
+			return (trip.id, trip.version, catalog_version, g.user.id)
+	for trip in trips:
+		if fragment_key(trip) is not None:
+			sections[trip.id] = fragment_cache.get(fragment_key(trip))
+	missing = [trip for trip in trips if sections.get(trip.id) is None]
+	if missing:
+		# (trip id, item id) -> how many units the current user ordered
+		order_model = ArchivedOrder if archived else Order
+		query = db.session.query(order_model.trip_id, order_model.item_id, db.func.sum(order_model.count)) \
+			.filter(order_model.trip_id.in_([trip.id for trip in missing]), order_model.user_id == g.user.id) \
+			.group_by(order_model.trip_id, order_model.item_id)
+		user_counts = {(trip_id, item_id): count for trip_id, item_id, count in query}
+		if archived:
+			totals = {trip.id: (trip.users, trip.units) for trip in missing}
+		else:
+			totals = trip_totals([trip.id for trip in missing])
+		for trip in missing:
+			destination = catalog.destinations[trip.destination_id]
+			section = Markup(render_template("_trip.html", trip=trip, user=g.user, destination=destination, menu=destination.items, user_counts=user_counts, totals=totals.get(trip.id, (0, 0))))
+			if fragment_key(trip) is not None:
+				fragment_cache.put(fragment_key(trip), section)
+			sections[trip.id] = section
+	return conditional(make_response(render_template("date.html",
+		**GLOBAL_PARAMS,
+		user=g.user,
+		date=date,
+		next_date=date + datetime.timedelta(days=7),
+		prev_date=date + datetime.timedelta(days=-7),
+		trips=trips,
+		sections=sections,
+		destinations=catalog.destinations.values(),
+		last_event=last_event,
+		msg=request.args.get("msg"),
+		msg_severity=request.args.get("msg_severity"),
+	)), etag, last_modified)
+
+
+@route("/<date>/", methods=["POST"])
+@require_user
+@retry_on_lock
+def date_submit_trip(date):
+	try:
+		destination = get_catalog().destinations[int(request.form["destination"])]
+	except (KeyError, ValueError):
+		abort(400, "No such destination.")
+	trip = Trip(user_id=g.user.id, destination_id=destination.id, date=parse_date(date))
+	if ArchivedTrip.query.filter_by(date=trip.date).first() is not None:
+		return redirect(url_for("date_show", date=date, msg="That date is archived, it can't get new trips.", msg_severity="error"))
+	db.session.add(trip)
+	try:
+		db.session.flush()
+		publish_event(trip.date, 'trip-added', trip=trip.id, destination=destination.name, buyer=g.user.name)
+		db.session.commit()
+		return redirect(url_for("date_show", date=date))
+	except sqlalchemy.exc.IntegrityError:
+		db.session.rollback()
+		return redirect(url_for("date_show", date=date, msg="You've already added a trip to that destination!", msg_severity="error"))
+
+
+def set_order_counts(trip, user, counts):
+	'''Set how many units of each item (by id) `user` orders on `trip`.
+	Looks up all items and existing order lines at once, and applies the difference as bulk inserts, updates and deletes.'''
+	max_count = int(current_app.config.get('MAX_ORDER_COUNT', 16))
+	for count in counts.values():
+		if count > max_count:
+			abort(400, "You can't order that many items. You can thank the person that ordered 65535 drinks once.")
+		if count < 0:
+			abort(400, "You can't order a negative number of items. What does that even mean?")
+	if not counts:
+		return
+
+	catalog_items = get_catalog().items
+	items = {item_id: catalog_items[item_id] for item_id in counts if item_id in catalog_items and catalog_items[item_id].destination_id == trip.destination_id}
+	if len(items) != len(counts):
+		abort(400, "That item isn't on the menu of this trip.")
+	lines = {}
+	for order in Order.query.filter(Order.trip_id == trip.id, Order.user_id == user.id, Order.item_id.in_(counts)):
+		lines.setdefault(order.item_id, []).append(order)
+
+	inserts, updates, deletes = [], [], []
+	debt = 0
+	for item_id, count in counts.items():
+		item = items[item_id]
+		if item.historical and count != 0:
+			abort(400, "That item is not orderable any more.")
+		orders = lines.get(item_id, [])
+		current = sum(o.count for o in orders)
+		if current > count:
+			# Take units away from unsettled lines first
+			excess = current - count
+			for order in sorted(orders, key=lambda o: o.settled):
+				if excess == 0:
+					break
+				taken = min(order.count, excess)
+				excess -= taken
+				debt -= order_debt(taken, item.price, order.settled, user.id, trip.user_id)
+				if taken == order.count:
+					deletes.append(order.id)
+				else:
+					updates.append({'id': order.id, 'count': order.count - taken})
+		elif current < count:
+			settled = item.price <= 0 or trip.user_id == user.id
+			debt += order_debt(count - current, item.price, settled, user.id, trip.user_id)
+			order = next((o for o in orders if o.settled == settled), None)
+			if order is None:
+				inserts.append({'trip_id': trip.id, 'item_id': item_id, 'user_id': user.id, 'settled': settled, 'count': count - current})
+			else:
+				updates.append({'id': order.id, 'count': order.count + count - current})
+
+	if inserts:
+		db.session.bulk_insert_mappings(Order, inserts)
+	if updates:
+		db.session.bulk_update_mappings(Order, updates)
+	if deletes:
+		Order.query.filter(Order.id.in_(deletes)).delete(synchronize_session=False)
+	if inserts or updates or deletes:
+		touch_trip(trip.id)
+		users, units = trip_totals([trip.id]).get(trip.id, (0, 0))
+		publish_event(trip.date, 'counts', trip=trip.id, users=users, units=units)
+	adjust_balances({(user.id, trip.user_id): debt})
+
+
+@route("/trip/<int:trip_id>/order", methods=["POST"])
+@require_user
+@retry_on_lock
+def trip_submit_order(trip_id):
+	trip = Trip.query.filter_by(id=trip_id).first()
+	if trip is None:
+		abort(404, "No such trip.")
+	if trip.closed:
+		abort(400, "This trip is already closed.")
+	counts = {}
+	for item_id, count in request.form.to_dict().items():
+		if not item_id.startswith("item-"):
+			continue
+		try:
+			counts[int(item_id.replace("item-", "", 1))] = int(count)
+		except ValueError:
+			abort(400, "That's not a number.")
+	set_order_counts(trip, g.user, counts)
+	db.session.commit()
+
+	return redirect(url_for("date_show", date=trip.date, msg="Order accepted!", msg_severity='success'))
+
+
+@route("/trip/<int:trip_id>/close", methods=["POST"])
+@require_user
+@retry_on_lock
+def trip_close(trip_id):
+	trip = Trip.query.filter_by(id=trip_id).first()
+	if trip is None:
+		abort(404, "No such trip.")
+	if g.user.id != trip.user_id:
+		abort(403, "You can't close someone else's trip.")
+	trip.closed = True
+	db.session.add(trip)
+	touch_trip(trip.id)
+	publish_event(trip.date, 'trip-closed', trip=trip.id)
+	db.session.commit()
+	return redirect(url_for("trip_show", trip_id=trip_id))
+
+
+@route("/trip/<int:trip_id>")
+@require_user
+def trip_show(trip_id):
+	trip = find_trip(trip_id)
+	if trip is None:
+		abort(404, "No such trip.")
+	if g.user.id != trip.user_id:
+		abort(403, "You can't read someone else's order list.")
+	show_users = "users" in request.args
+	catalog = get_catalog()
+	etag = make_etag('trip', trip.id, trip.version, show_users, catalog.version, g.user)
+	response = not_modified(etag, trip.modified)
+	if response is not None:
+		return response
+	trip_items = trip.get_items_grouped(catalog, with_users=show_users)
+	total = sum(o["item"].price * o["count"] for o in trip_items)
+	return conditional(make_response(render_template("trip.html",
+		**GLOBAL_PARAMS,
+		user=g.user,
+		trip=trip,
+		destination=catalog.destinations[trip.destination_id],
+		trip_items=trip_items,
+		show_users=show_users,
+		total=total,
+	)), etag, trip.modified)
+
+
+def _unsettled_total(query):
+	return query.filter(Order.settled == False).with_entities(db.func.sum(Order.count * Item.price)).scalar() or 0
+
+
+def _settle_queries(order_model, trip_model):
+	'''The orders on the settle page filtered by the request, (ordered by us but not bought by us, not ordered by us but bought by us).
+	`order_model` and `trip_model` are Order and Trip, or ArchivedOrder and ArchivedTrip.'''
+	query_out = order_model.query.join(order_model.trip).join(order_model.item).filter(order_model.user_id == g.user.id, trip_model.user_id != g.user.id)
+	query_in = order_model.query.join(order_model.trip).join(order_model.item).filter(order_model.user_id != g.user.id, trip_model.user_id == g.user.id)
+	criteria = []
+	if 'trip' in request.args:
+		criteria.append(order_model.trip_id.in_(request.args.getlist('trip')))
+	criteria += [trip_model.date > after for after in request.args.getlist('after')]
+	criteria += [trip_model.date >= since for since in request.args.getlist('since')]
+	criteria += [trip_model.date < before for before in request.args.getlist('before')]
+	criteria += [trip_model.date <= until for until in request.args.getlist('until')]
+	if 'settled' in request.args:
+		criteria.append(order_model.settled == parse_bool(request.args['settled']))
+	query_out = query_out.filter(*criteria)
+	query_in = query_in.filter(*criteria)
+	if 'with' in request.args:
+		with_ids = list(map(int, request.args.getlist('with')))
+		# for outgoing (ordered by us), check the Trip's user
+		query_out = query_out.filter(trip_model.user_id.in_(with_ids))
+		# For incoming (ordered from us), check the Order's user
+		query_in = query_in.filter(order_model.user_id.in_(with_ids))
+	return query_out, query_in
+
+
+@route("/settle")
+@require_user
+def settle_show():
+	query_out, query_in = _settle_queries(Order, Trip)
+	# Archived orders are all settled, so they are part of the history, but never of what is still owed
+	if parse_bool(request.args.get('settled', 'true')):
+		archived_out, archived_in = _settle_queries(ArchivedOrder, ArchivedTrip)
+	else:
+		archived_out = archived_in = None
+	# Totals come from the balance ledger, unless the orders are filtered by something the ledger doesn't know about
+	balances_out = Balance.query.filter(Balance.debtor_id == g.user.id)
+	balances_in = Balance.query.filter(Balance.creditor_id == g.user.id)
+	use_ledger = not any(key in request.args for key in ('trip', 'after', 'since', 'before', 'until'))
+	filtered = not use_ledger or any(key in request.args for key in ('with', 'settled'))
+	if 'with' in request.args:
+		with_ids = list(map(int, request.args.getlist('with')))
+		balances_out = balances_out.filter(Balance.creditor_id.in_(with_ids))
+		balances_in = balances_in.filter(Balance.debtor_id.in_(with_ids))
+
+	if use_ledger:
+		total_out = balances_out.with_entities(db.func.sum(Balance.amount)).scalar() or 0
+		total_in = balances_in.with_entities(db.func.sum(Balance.amount)).scalar() or 0
+	else:
+		total_out = _unsettled_total(query_out)
+		total_in = _unsettled_total(query_in)
+
+	page = max(request.args.get('page', 1, type=int), 1)
+	page_size = int(current_app.config.get('SETTLE_PAGE_SIZE', 50))
+	options = (
+		contains_eager(Order.trip).joinedload(Trip.user),
+		contains_eager(Order.item),
+		joinedload(Order.user),
+	)
+	archived_options = (
+		contains_eager(ArchivedOrder.trip).joinedload(ArchivedTrip.user),
+		contains_eager(ArchivedOrder.item),
+		joinedload(ArchivedOrder.user),
+	)
+
+	def get_page(query, archived_query):
+		if archived_query is None:
+			return query.options(*options).order_by(Trip.date.desc(), Order.id.desc()).offset((page - 1) * page_size).limit(page_size + 1).all()
+		# Page through both tables at once by id, then load the orders of the page from where they are
+		page_ids = db.union_all(
+				query.with_entities(db.literal(False).label('archived'), Order.id.label('id'), Trip.date.label('date')).statement,
+				archived_query.with_entities(db.literal(True), ArchivedOrder.id, ArchivedTrip.date).statement,
+			) \
+			.order_by(db.literal_column('date').desc(), db.literal_column('id').desc()) \
+			.offset((page - 1) * page_size) \
+			.limit(page_size + 1)
+		rows = [(bool(archived), order_id) for archived, order_id, _ in db.session.execute(page_ids)]
+		hot_ids = [order_id for archived, order_id in rows if not archived]
+		archived_ids = [order_id for archived, order_id in rows if archived]
+		orders = {}
+		if hot_ids:
+			orders.update(((False, o.id), o) for o in query.options(*options).filter(Order.id.in_(hot_ids)))
+		if archived_ids:
+			orders.update(((True, o.id), o) for o in archived_query.options(*archived_options).filter(ArchivedOrder.id.in_(archived_ids)))
+		return [orders[row] for row in rows]
+	outgoing = get_page(query_out, archived_out)
+	incoming = get_page(query_in, archived_in)
+
+	args = {key: values for key, values in request.args.lists() if key not in ('msg', 'msg_severity')}
+	prev_page = url_for('settle_show', **{**args, 'page': page - 1}) if page > 1 else None
+	next_page = url_for('settle_show', **{**args, 'page': page + 1}) if len(outgoing) > page_size or len(incoming) > page_size else None
+
+	return render_template("settle.html",
+		**GLOBAL_PARAMS,
+		user=g.user,
+		outgoing=outgoing[:page_size],
+		incoming=incoming[:page_size],
+		total_out=total_out,
+		total_in=total_in,
+		prev_page=prev_page,
+		next_page=next_page,
+		filtered=filtered,
+		with_ids=request.args.getlist('with'),
+		trip_ids=request.args.getlist('trip'),
+		today=now(),
+		msg=request.args.get("msg"),
+		msg_severity=request.args.get("msg_severity"),
+	)
+
+
+@route("/settle", methods=["POST"])
+@require_user
+@retry_on_lock
+def settle_update():
+	action = request.form.get("action")
+	if action is not None:
+		try:
+			if action == "settle-with":
+				changed = settle_orders(g.user.id, user_id=int(request.form["with"]))
+			elif action == "settle-until":
+				changed = settle_orders(g.user.id, until=parse_date(request.form["until"]))
+			elif action == "settle-trip":
+				changed = settle_orders(g.user.id, trip_id=int(request.form["trip"]))
+			else:
+				abort(400, "Unknown action.")
+		except (KeyError, ValueError):
+			abort(400, "Missing or invalid parameters for this action.")
+		db.session.commit()
+		return redirect(url_for("settle_show", settled="false", msg=f"Marked {changed} orders as settled.", msg_severity="success"))
+
+	form = request.form.to_dict()
+	orders_form = {}
+	for key, value in form.items():
+		if key.startswith("old-"):
+			order_id = int(key.replace("old-", "", 1))
+			orders_form[order_id] = (value == "on", form.get(f"order-{order_id}", "off") == "on")
+	# Only the buyer of a trip can mark its orders as settled
+	orders_db = Order.query.join(Order.trip).join(Order.item) \
+		.options(contains_eager(Order.trip), contains_eager(Order.item)) \
+		.filter(Order.id.in_(orders_form), Trip.user_id == g.user.id) \
+		.all()
+	deltas = {}
+	for order in orders_db:
+		old_state, new_state = orders_form[order.id]
+		if new_state != old_state and new_state != order.settled:
+			debt = order_debt(order.count, order.item.price, False, order.user_id, order.trip.user_id)
+			key = (order.user_id, order.trip.user_id)
+			deltas[key] = deltas.get(key, 0) + (-debt if new_state else debt)
+			order.settled = new_state
+			db.session.add(order)
+	adjust_balances(deltas)
+	db.session.commit()
+	return redirect(url_for("settle_show"))
+
+
+@route("/settle/plan")
+@require_user
+def settle_plan_show():
+	transfers, token = settlement.plan()
+	names = dict(db.session.query(User.id, User.name).filter(User.id.in_({user_id for transfer in transfers for user_id in transfer[:2]}))) if transfers else {}
+	return render_template("settle_plan.html",
+		**GLOBAL_PARAMS,
+		user=g.user,
+		transfers=[(names[debtor_id], names[creditor_id], amount) for debtor_id, creditor_id, amount in transfers],
+		pairs=Balance.query.filter(Balance.amount != 0).count(),
+		token=token,
+	)
+
+
+@route("/stats")
+@require_user
+def stats_show():
+	until = reports.parse_month(request.args['until']) if 'until' in request.args else now().replace(day=1)
+	if 'since' in request.args:
+		since = reports.parse_month(request.args['since'])
+	else:
+		since = (until - datetime.timedelta(days=365)).replace(day=1)
+	results = [(name, reports.REPORTS[name][0], reports.monthly_report(name, since, until)) for name in reports.REPORTS]
+	return render_template("stats.html",
+		**GLOBAL_PARAMS,
+		user=g.user,
+		since=since,
+		until=until,
+		reports=results,
+		debt=reports.debt_report(),
+	)
+
+
+def init_app(app):
+	user_cache.maxsize = int(app.config.get('USER_CACHE_SIZE', 1024))
+	user_cache.ttl = float(app.config.get('USER_CACHE_TTL', 300))
+	user_cache.poll_interval = float(app.config.get('USER_CACHE_POLL_INTERVAL', 5))
+	fragment_cache.maxsize = int(app.config.get('FRAGMENT_CACHE_SIZE', 512))
+	fragment_cache.ttl = float(app.config.get('FRAGMENT_CACHE_TTL', 24 * 60 * 60))